@@ -0,0 +1,58 @@
+"""
+Benchmark CollectionIndex construction and lookups on synthetic libraries.
+
+    python benchmarks/bench_collection_index.py [n ...]
+
+Each size is run against three tree shapes: a random forest, a balanced
+10-ary tree, and a forest of 200-deep chains. (A single n-deep chain is not
+used: its full paths alone are O(n^2) characters.)
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from collection_index import CollectionIndex  # noqa: E402
+
+
+def make_collections(n, shape, seed=0):
+    rng = random.Random(seed)
+    collections = []
+    for i in range(n):
+        if i == 0:
+            parent = False
+        elif shape == "deep":
+            parent = f"K{i - 1}" if i % 200 else False
+        elif shape == "balanced":
+            parent = f"K{(i - 1) // 10}"
+        else:
+            parent = f"K{rng.randrange(i)}" if rng.random() > 0.05 else False
+        collections.append({"data": {"key": f"K{i}", "name": f"Collection {i}", "parentCollection": parent}})
+    rng.shuffle(collections)
+    return collections
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, (time.perf_counter() - start) * 1000
+
+
+def main(sizes):
+    print(f"{'n':>8} {'shape':>9} {'build ms':>9} {'flatten ms':>11} {'tree ms':>8} {'root desc ms':>13}")
+    for n in sizes:
+        for shape in ("random", "balanced", "deep"):
+            collections = make_collections(n, shape)
+            index, build_ms = timed(lambda: CollectionIndex("user", 0, collections))
+            flat, flatten_ms = timed(lambda: index.flatten("personal"))
+            _, tree_ms = timed(index.render_tree)
+            desc, desc_ms = timed(lambda: index.descendants("K0"))
+            assert len(flat) == n
+            assert shape != "balanced" or len(desc) == n - 1
+            print(f"{n:>8} {shape:>9} {build_ms:>9.1f} {flatten_ms:>11.1f} {tree_ms:>8.1f} {desc_ms:>13.1f}")
+
+
+if __name__ == "__main__":
+    main([int(a) for a in sys.argv[1:]] or [10_000, 50_000, 100_000])
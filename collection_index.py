@@ -0,0 +1,133 @@
+"""
+Per-library index over Zotero collections.
+
+Built once from a library's raw /collections listing and then shared by every
+code path that needs collection names, full paths, parent/child structure or
+nested subcollections, instead of each one refetching and rebuilding them.
+
+Construction is a single iterative preorder walk, so it is O(n) in the number
+of collections and has no recursion limit on deep trees. Each collection's
+subtree is stored as a [start, end) slice of the preorder list, which makes
+descendant lookups a slice instead of a recursive gather.
+"""
+from ngram_index import TrigramIndex
+
+
+class CollectionIndex:
+    def __init__(self, library_type, library_id, collections, name=None):
+        self.library_type = library_type  # "user" or "group"
+        self.library_id = library_id
+        self.name = name or f"{library_type}_{library_id}"
+
+        # key -> collection "data" dict, in listing order
+        self.nodes = {}
+        for col in collections:
+            data = col["data"]
+            self.nodes[data["key"]] = data
+
+        # parent key -> child keys; top-level collections live under None
+        self.children = {}
+        for key, data in self.nodes.items():
+            parent = data.get("parentCollection") or None
+            self.children.setdefault(parent, []).append(key)
+
+        self.paths = {}
+        self.order = []   # preorder of all collections, top-level trees first
+        self._start = {}  # key -> position in self.order
+        self._end = {}    # key -> end (exclusive) of its subtree in self.order
+
+        self._walk(self.children.get(None, []))
+        self.top_level_count = len(self.order)
+
+        # Collections whose parent is missing from the listing (or that sit in
+        # a parent cycle) still get a path and descendants, rooted at themselves.
+        for key in self.nodes:
+            if key not in self._start:
+                self._walk([key])
+
+        self._path_index = None
+
+    def _walk(self, roots):
+        stack = [(key, None) for key in reversed(roots)]
+        while stack:
+            key, parent = stack.pop()
+            if key is None:
+                # Marker pushed after a node's children: its subtree is complete
+                self._end[parent] = len(self.order)
+                continue
+            if key in self._start:
+                continue
+            name = self.nodes[key]["name"]
+            self.paths[key] = f"{self.paths[parent]}/{name}" if parent else name
+            self._start[key] = len(self.order)
+            self.order.append(key)
+            stack.append((None, key))
+            for child in reversed(self.children.get(key, [])):
+                stack.append((child, key))
+
+    def __contains__(self, key):
+        return key in self.nodes
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def full_path(self, key):
+        return self.paths[key]
+
+    def descendants(self, key):
+        """
+        Return the keys of all collections nested (at any depth) under key.
+        """
+        if key not in self._start:
+            return set()
+        return set(self.order[self._start[key] + 1:self._end[key]])
+
+    def match_paths(self, query, n=3, cutoff=0.4):
+        """
+        Return up to n (key, similarity) pairs for the collections whose full
+        path best matches query, using a trigram index built on first use.
+        """
+        if self._path_index is None:
+            path_index = TrigramIndex()
+            for key, path in self.paths.items():
+                path_index.add(key, path)
+            self._path_index = path_index
+        return self._path_index.search(query, n=n, cutoff=cutoff)
+
+    def flatten(self, library_label):
+        """
+        Return every collection reachable from the top level as flat dicts,
+        parents before their children.
+        """
+        flat = []
+        for key in self.order[:self.top_level_count]:
+            data = self.nodes[key]
+            flat.append({
+                "name": data["name"],
+                "key": key,
+                "full_path": self.paths[key],
+                "parent_key": data.get("parentCollection"),
+                "library_type": library_label
+            })
+        return flat
+
+    def render_tree(self):
+        """
+        Return an indented plain-text tree of the library's collections,
+        siblings sorted by name.
+        """
+        def by_name(keys):
+            # Reversed so that popping from the stack yields ascending order
+            return reversed(sorted(keys, key=lambda k: self.nodes[k]["name"]))
+
+        lines = []
+        seen = set()
+        stack = [(key, 0) for key in by_name(self.children.get(None, []))]
+        while stack:
+            key, level = stack.pop()
+            if key in seen:
+                continue
+            seen.add(key)
+            lines.append("  " * level + f"- {self.nodes[key]['name']}")
+            stack.extend((child, level + 1) for child in by_name(self.children.get(key, [])))
+        return "\n".join(lines)
@@ -0,0 +1,180 @@
+"""
+Local BM25 full-text search over the PDF text this service has extracted.
+
+Each library (e.g. "users/123", "groups/456") gets its own inverted index,
+filled as a side effect of /summarize_collection and /read_pdf, so searching
+inside papers never has to touch Zotero. A posting holds the
+document number, term frequency, and the page and in-page offset of the
+term's first occurrence, which double as snippet locations and /read_pdf
+cursors.
+
+Each library's index is a SQLite file in SEARCH_INDEX_DIR, shared by all
+gunicorn workers (WAL mode). Adding a document replaces its postings in one
+transaction, so what one worker indexes is immediately searchable from the
+others and survives restarts, with nothing to snapshot.
+"""
+import heapq
+import math
+import os
+import re
+import tempfile
+import threading
+
+from worker_local import SqliteConnections
+
+
+SEARCH_INDEX_DIR = os.environ.get(
+    "SEARCH_INDEX_DIR", os.path.join(tempfile.gettempdir(), "zotero-gpt-search-index")
+)
+
+PAGE_BREAK = "\f"
+TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+STOPWORDS = frozenset("""
+a an and are as at be but by for from has have in is it its of on or that the their this to
+was were which with we our not can also these those than such into been may more other
+""".split())
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    doc INTEGER PRIMARY KEY,
+    attachment_key TEXT NOT NULL UNIQUE,
+    item_key TEXT,
+    title TEXT,
+    length INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT NOT NULL,
+    doc INTEGER NOT NULL,
+    freq INTEGER NOT NULL,
+    page INTEGER NOT NULL,
+    page_offset INTEGER NOT NULL,
+    PRIMARY KEY (term, doc)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc);
+"""
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+
+def tokenize(text):
+    """
+    Yield (token, page, offset in page) for every indexable word in text,
+    with pages separated by PAGE_BREAK.
+    """
+    page = 1
+    page_start = 0
+    for m in TOKEN_RE.finditer(text):
+        while True:
+            brk = text.find(PAGE_BREAK, page_start, m.start())
+            if brk < 0:
+                break
+            page += 1
+            page_start = brk + 1
+        token = m.group().lower()
+        if len(token) > 1 and token not in STOPWORDS and not token.isdigit():
+            yield token, page, m.start() - page_start
+
+
+def query_terms(query):
+    return [t for t in TOKEN_RE.findall(query.lower()) if len(t) > 1 and t not in STOPWORDS]
+
+
+class FulltextIndex:
+    def __init__(self, lib_path, directory=SEARCH_INDEX_DIR):
+        self.lib_path = lib_path
+        self.path = os.path.join(directory, lib_path.replace("/", "_") + ".sqlite3")
+        self._connections = SqliteConnections(self.path, SCHEMA)
+
+    def _db(self):
+        return self._connections.get()
+
+    def __len__(self):
+        return self._db().execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def add(self, attachment_key, text, item_key=None, title=None):
+        """
+        Index (or re-index) one attachment's text.
+        """
+        stats = {}  # term -> [freq, first page, first offset]
+        length = 0
+        for token, page, offset in tokenize(text):
+            length += 1
+            entry = stats.get(token)
+            if entry is None:
+                stats[token] = [1, page, offset]
+            else:
+                entry[0] += 1
+
+        conn = self._db()
+        with conn:
+            self._remove(conn, attachment_key)
+            doc = conn.execute(
+                "INSERT INTO docs (attachment_key, item_key, title, length) VALUES (?, ?, ?, ?)",
+                (attachment_key, item_key or attachment_key, title, length)
+            ).lastrowid
+            conn.executemany(
+                "INSERT INTO postings (term, doc, freq, page, page_offset) VALUES (?, ?, ?, ?, ?)",
+                [(token, doc, freq, page, offset) for token, (freq, page, offset) in stats.items()]
+            )
+
+    def remove(self, attachment_key):
+        conn = self._db()
+        with conn:
+            self._remove(conn, attachment_key)
+
+    def _remove(self, conn, attachment_key):
+        row = conn.execute("SELECT doc FROM docs WHERE attachment_key = ?", (attachment_key,)).fetchone()
+        if row is not None:
+            conn.execute("DELETE FROM postings WHERE doc = ?", row)
+            conn.execute("DELETE FROM docs WHERE doc = ?", row)
+
+    def search(self, query, limit=10):
+        """
+        Return up to limit (score, attachment key, meta, snippets) tuples ranked
+        by BM25, where snippets lists (term, page, offset) for each matched term.
+        """
+        terms = query_terms(query)
+        conn = self._db()
+        live, total_length = conn.execute("SELECT COUNT(*), TOTAL(length) FROM docs").fetchone()
+        if not live or not terms:
+            return []
+        avg_length = total_length / live or 1
+        scores = {}
+        matched = {}
+        for term in dict.fromkeys(terms):
+            rows = conn.execute(
+                "SELECT p.doc, p.freq, p.page, p.page_offset, d.length "
+                "FROM postings p JOIN docs d ON d.doc = p.doc WHERE p.term = ?",
+                (term,)
+            ).fetchall()
+            if not rows:
+                continue
+            idf = math.log(1 + (live - len(rows) + 0.5) / (len(rows) + 0.5))
+            for doc, tf, page, offset, length in rows:
+                norm = tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+                scores[doc] = scores.get(doc, 0.0) + idf * tf * (BM25_K1 + 1) / norm
+                matched.setdefault(doc, []).append((term, page, offset))
+
+        top = heapq.nlargest(limit, scores.items(), key=lambda kv: kv[1])
+        results = []
+        for doc, score in top:
+            row = conn.execute("SELECT attachment_key, item_key, title FROM docs WHERE doc = ?", (doc,)).fetchone()
+            if row is not None:
+                results.append((score, row[0], {"item_key": row[1], "title": row[2]}, matched[doc]))
+        return results
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_library_index(lib_path):
+    """
+    Return the index for a library path such as "users/123".
+    """
+    with _indexes_lock:
+        index = _indexes.get(lib_path)
+        if index is None:
+            index = _indexes[lib_path] = FulltextIndex(lib_path)
+        return index
@@ -0,0 +1,212 @@
+"""
+Background jobs for long-running analyses, with a persisted job store.
+
+A job is a generator of event dicts (see zotero_api.summarize_collection_events)
+run on a small per-worker thread pool at bulk upstream priority. Every event
+is written to a SQLite store as it arrives: "document" events accumulate in
+the partial result and advance the progress counts, other events are kept by
+type, "summary" becomes the final result and "error" fails the job. Any
+gunicorn worker can therefore answer a status poll, whichever one runs it.
+
+Submitting a job while an identical one (same kind, API key and parameters)
+is still pending or running returns the existing job instead of starting
+another. Only a hash of the API key is stored; the key itself stays in the
+memory of the worker running the job, so a job whose worker died is reported
+as failed instead of being resumed. Finished jobs are deleted after
+JOB_TTL seconds.
+"""
+import contextvars
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from key_cache import hash_api_key
+from rate_limit import BULK, upstream_priority
+from worker_local import ProcessLocal, SqliteConnections
+
+
+logger = logging.getLogger(__name__)
+
+JOB_DB_PATH = os.environ.get(
+    "JOB_DB_PATH", os.path.join(tempfile.gettempdir(), "zotero-gpt-jobs", "jobs.sqlite3")
+)
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "2"))
+JOB_TTL = float(os.environ.get("JOB_TTL", str(24 * 3600)))
+# Least seconds between progress writes of one job (the final state is always written)
+JOB_PROGRESS_INTERVAL = float(os.environ.get("JOB_PROGRESS_INTERVAL", "1"))
+
+PENDING, RUNNING, DONE, FAILED = "pending", "running", "done", "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    owner TEXT NOT NULL,
+    dedup_key TEXT NOT NULL,
+    params TEXT NOT NULL,
+    status TEXT NOT NULL,
+    pid INTEGER,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    total INTEGER,
+    partial TEXT,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_dedup ON jobs (dedup_key, status);
+"""
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobStore:
+    def __init__(self, path=JOB_DB_PATH):
+        self.path = path
+        self._connections = SqliteConnections(self.path, SCHEMA, row_factory=sqlite3.Row, isolation_level=None)
+
+    def _db(self):
+        return self._connections.get()
+
+    def create(self, kind, owner, params):
+        """
+        Insert a pending job, unless an identical one is pending or running.
+        Returns (job id, created).
+        """
+        dedup_key = hashlib.sha256(json.dumps([kind, owner, params], sort_keys=True).encode("utf-8")).hexdigest()
+        now = time.time()
+        conn = self._db()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "DELETE FROM jobs WHERE status IN (?, ?) AND updated_at < ?", (DONE, FAILED, now - JOB_TTL)
+            )
+            for row in conn.execute(
+                "SELECT id, status, pid FROM jobs WHERE dedup_key = ? AND status IN (?, ?)",
+                (dedup_key, PENDING, RUNNING)
+            ).fetchall():
+                if _pid_alive(row["pid"]):
+                    conn.execute("COMMIT")
+                    return row["id"], False
+                self._interrupt(conn, row["id"])
+
+            job_id = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO jobs (id, kind, owner, dedup_key, params, status, pid, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, kind, owner, dedup_key, json.dumps(params), PENDING, os.getpid(), now, now)
+            )
+            conn.execute("COMMIT")
+            return job_id, True
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _interrupt(self, conn, job_id):
+        conn.execute(
+            "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ? AND status IN (?, ?)",
+            (FAILED, "Interrupted: the worker running this job stopped", time.time(), job_id, PENDING, RUNNING)
+        )
+
+    def update(self, job_id, **fields):
+        if "partial" in fields:
+            fields["partial"] = json.dumps(fields["partial"])
+        if "result" in fields:
+            fields["result"] = json.dumps(fields["result"])
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        self._db().execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def get(self, job_id, owner):
+        """
+        Return the job as a dict, or None if there is no such job for owner.
+        """
+        conn = self._db()
+        row = conn.execute("SELECT * FROM jobs WHERE id = ? AND owner = ?", (job_id, owner)).fetchone()
+        if row is None:
+            return None
+        if row["status"] in (PENDING, RUNNING) and not _pid_alive(row["pid"]):
+            self._interrupt(conn, job_id)
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return {
+            "job_id": row["id"],
+            "kind": row["kind"],
+            "params": json.loads(row["params"]),
+            "status": row["status"],
+            "created_at": row["created_at"],
+            "updated_at": row["updated_at"],
+            "progress": {"done": row["done"], "total": row["total"]},
+            "partial": json.loads(row["partial"]) if row["partial"] else None,
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "error": row["error"]
+        }
+
+
+job_store = JobStore()
+
+_executor = ProcessLocal(lambda: ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix="job"))
+
+
+def _run(job_id, run, api_key, params):
+    upstream_priority.set(BULK)
+    job_store.update(job_id, status=RUNNING)
+    partial = {"documents": []}
+    progress = {}
+    written_at = 0.0
+    events = run(api_key, **params)
+    try:
+        for event in events:
+            kind = event["type"]
+            record = {k: v for k, v in event.items() if k != "type"}
+            if kind == "error":
+                job_store.update(job_id, status=FAILED, error=record.get("error"))
+                return
+            if kind == "summary":
+                job_store.update(job_id, status=DONE, result=record, partial=partial, **progress)
+                return
+            if kind == "document":
+                partial["documents"].append(record)
+                progress = {"done": record["done"], "total": record["total"]}
+            else:
+                partial[kind] = record
+            # The partial result is rewritten whole, so large jobs only do it now and then
+            if kind != "document" or time.monotonic() - written_at >= JOB_PROGRESS_INTERVAL:
+                job_store.update(job_id, partial=partial, **progress)
+                written_at = time.monotonic()
+        job_store.update(job_id, status=DONE, partial=partial, **progress)
+    except Exception as e:
+        logger.error(f"[jobs] Job {job_id} failed: {e}")
+        job_store.update(job_id, status=FAILED, error=str(e))
+    finally:
+        events.close()
+
+
+def submit_job(kind, api_key, params, run):
+    """
+    Queue run(api_key, **params), a generator of events, as a background job.
+    Returns (job id, created); created is False when an identical job was
+    already pending or running.
+    """
+    job_id, created = job_store.create(kind, hash_api_key(api_key), params)
+    if created:
+        # A fresh context, so the job does not inherit the submitting request's priority
+        _executor.get().submit(contextvars.Context().run, _run, job_id, run, api_key, params)
+    return job_id, created
+
+
+def get_job(job_id, api_key):
+    return job_store.get(job_id, hash_api_key(api_key))
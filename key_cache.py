@@ -0,0 +1,72 @@
+"""
+In-process cache of what an API key resolves to (userID, group memberships).
+
+Entries are keyed by a SHA-256 digest of the API key, so the key itself is
+never kept in memory beyond the request that carried it. Entries expire after
+a TTL and the least recently used entry is evicted once the cache is full.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+KEY_CACHE_TTL = float(os.environ.get("ZOTERO_KEY_CACHE_TTL", "300"))
+KEY_CACHE_SIZE = int(os.environ.get("ZOTERO_KEY_CACHE_SIZE", "1024"))
+
+
+def hash_api_key(api_key):
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+class KeyInfoCache:
+    def __init__(self, ttl=KEY_CACHE_TTL, max_entries=KEY_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # digest -> (expires_at, info dict)
+        self._lock = threading.Lock()
+
+    def get(self, api_key):
+        """
+        Return the cached info dict for api_key, or None if missing or expired.
+        """
+        digest = hash_api_key(api_key)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                return None
+            expires_at, info = entry
+            if expires_at < time.monotonic():
+                del self._entries[digest]
+                return None
+            self._entries.move_to_end(digest)
+            return info
+
+    def update(self, api_key, **fields):
+        """
+        Merge fields into the entry for api_key. A new entry starts its TTL;
+        updating an existing one keeps the original expiry.
+        """
+        digest = hash_api_key(api_key)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None or entry[0] < now:
+                entry = (now + self.ttl, {})
+            entry[1].update(fields)
+            self._entries[digest] = entry
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, api_key):
+        with self._lock:
+            self._entries.pop(hash_api_key(api_key), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+key_cache = KeyInfoCache()
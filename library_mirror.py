@@ -0,0 +1,391 @@
+"""
+Local SQLite mirror of Zotero libraries, kept current with version-based sync.
+
+Each library (e.g. "users/123", "groups/456") is mirrored into its own
+SQLite file, as two scopes synced separately: COLLECTIONS and ITEMS. Routes
+that only need the collection tree sync only collections, so they never pay
+for downloading a large library's items. The first sync of a scope
+downloads all of it; after that a sync is a single request for the scope's
+objects changed since its stored version, sent with If-Modified-Since-Version
+so an unchanged library costs one 304. When something did change, only the
+changed objects (?since=) and the /deleted listing are fetched and applied
+in one transaction, and the scope's stored version advances to the
+Last-Modified-Version Zotero reported. Item listings leave notes out for
+keys without notes access, so the items scope also tracks the version up to
+which it holds every note (NOTES); a key with notes access syncs from there.
+
+Syncs of the same scope are serialized within a worker and skipped when
+the same API key's last check is younger than ZOTERO_MIRROR_MAX_STALENESS
+seconds; a different key always gets its own check, so Zotero still rejects
+a key that lost access even while the mirror is fresh. Several
+gunicorn workers may share the files: SQLite runs in WAL mode, a row is only
+replaced by a newer version of it, deletions leave tombstones stamped with
+their version, and the stored scope versions never move backwards.
+"""
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from key_cache import hash_api_key
+from ngram_index import get_metadata_index
+from worker_local import SqliteConnections
+from zotero_client import run, zotero_aget, zotero_aget_all, zotero_get
+
+
+logger = logging.getLogger(__name__)
+
+MIRROR_DIR = os.environ.get(
+    "ZOTERO_MIRROR_DIR", os.path.join(tempfile.gettempdir(), "zotero-gpt-mirror")
+)
+MIRROR_MAX_STALENESS = float(os.environ.get("ZOTERO_MIRROR_MAX_STALENESS", "10"))
+
+# Sync scopes: each is synced on its own, with its own stored version
+COLLECTIONS, ITEMS = "collections", "items"
+# Version up to which the items scope also holds every note. Zotero leaves
+# notes out of item listings for keys without notes access, so a sync by
+# such a key advances ITEMS but not NOTES.
+NOTES = "notes"
+
+# Part of the file name, so a changed schema starts a fresh mirror
+MIRROR_FORMAT = 3
+
+# A row whose data is NULL is a tombstone: the object was deleted at (or
+# before) that row's version, so older listings must not bring it back.
+# items.changed is the file's change sequence (meta "changed") at the
+# transaction that last wrote the row, so in-memory indexes can catch up on
+# rows written by any worker.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS collections (
+    key TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    data TEXT
+);
+CREATE TABLE IF NOT EXISTS items (
+    key TEXT PRIMARY KEY,
+    version INTEGER NOT NULL,
+    item_type TEXT,
+    parent_item TEXT,
+    deleted INTEGER NOT NULL DEFAULT 0,
+    date_modified TEXT,
+    search_text TEXT,
+    data TEXT,
+    changed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS items_parent ON items (parent_item);
+CREATE INDEX IF NOT EXISTS items_changed ON items (changed);
+CREATE TABLE IF NOT EXISTS item_collections (
+    item_key TEXT NOT NULL,
+    collection_key TEXT NOT NULL,
+    PRIMARY KEY (collection_key, item_key)
+);
+CREATE INDEX IF NOT EXISTS item_collections_item ON item_collections (item_key);
+"""
+
+
+def _search_text(data):
+    """
+    Lowercased title, creator names and year, as matched by Zotero's
+    "titleCreatorYear" quick search.
+    """
+    names = " ".join(
+        f"{c.get('firstName', '')} {c.get('lastName', '')} {c.get('name', '')}"
+        for c in data.get("creators", [])
+    )
+    return f"{data.get('title', '')} {names} {data.get('date', '')[:4]}".lower()
+
+
+def _like_pattern(word):
+    escaped = word.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
+
+
+class LibraryMirror:
+    def __init__(self, lib_path, directory=MIRROR_DIR):
+        self.lib_path = lib_path
+        self.path = os.path.join(directory, f"{lib_path.replace('/', '_')}.v{MIRROR_FORMAT}.sqlite3")
+        self._checked_at = {}  # (scope, API key hash) -> time of its last successful check
+        self._sync_locks = {COLLECTIONS: threading.Lock(), ITEMS: threading.Lock()}
+        self._connections = SqliteConnections(self.path, SCHEMA)
+
+    def _db(self):
+        return self._connections.get()
+
+    def version(self, scope):
+        row = self._db().execute("SELECT value FROM meta WHERE name = ?", (f"{scope}_version",)).fetchone()
+        return int(row[0]) if row else 0
+
+    def sync(self, headers, scope=ITEMS, notes=False, force=False):
+        """
+        Bring one scope of the mirror (COLLECTIONS or ITEMS) up to date with
+        Zotero. notes tells whether the key's item listings include notes; a
+        key with notes access syncs items from the NOTES version, so notes
+        a key without it skipped are fetched then. Raises if Zotero rejects
+        the version check (e.g. the key cannot read this library).
+        """
+        notes = notes and scope == ITEMS
+        digest = hash_api_key(headers.get("Zotero-API-Key", ""))
+        with self._sync_locks[scope]:
+            now = time.monotonic()
+            checked_at = self._checked_at.get((scope, digest))
+            if not force and checked_at is not None and now - checked_at < MIRROR_MAX_STALENESS:
+                return
+            self._checked_at = {
+                check: t for check, t in self._checked_at.items() if now - t < MIRROR_MAX_STALENESS
+            }
+            since = self.version(NOTES if notes else scope)
+
+            check_headers = dict(headers)
+            if since:
+                check_headers["If-Modified-Since-Version"] = str(since)
+            params = {"since": since, "format": "versions"}
+            if scope == ITEMS:
+                params["includeTrashed"] = 1
+            res = zotero_get(f"/{self.lib_path}/{scope}", headers=check_headers, params=params)
+            if res.status_code == 304:
+                self._checked_at[(scope, digest)] = now
+                return
+            if res.status_code != 200:
+                raise Exception(f"Zotero request failed ({res.status_code}) for /{self.lib_path}/{scope}")
+            new_version = int(res.headers.get("Last-Modified-Version", 0))
+            changed = res.json()
+
+            objects, (deleted, deleted_version) = run(self._fetch_changes(headers, scope, since, bool(changed)))
+            # Deletions are stamped with the version /deleted reported them at
+            deleted_version = max(deleted_version, new_version)
+            if scope == COLLECTIONS:
+                self._apply_collections(objects, deleted, deleted_version, new_version)
+            else:
+                self._apply_items(objects, deleted, deleted_version, new_version, notes)
+            self._checked_at[(scope, digest)] = now
+            logger.debug(
+                f"[LibraryMirror] {self.lib_path} {scope}: v{since} -> v{new_version}, "
+                f"{len(objects)} changed, {len(deleted)} deleted"
+            )
+
+    async def _fetch_changes(self, headers, scope, since, changed):
+        """
+        Fetch one scope's changed objects, and its deleted keys with the
+        library version they were listed at, concurrently.
+        """
+        async def deleted():
+            if not since:
+                return [], 0
+            res = await zotero_aget(f"/{self.lib_path}/deleted", headers=headers, params={"since": since})
+            if res.status_code != 200:
+                raise Exception(f"Zotero request failed ({res.status_code}) for /{self.lib_path}/deleted")
+            return res.json().get(scope, []), int(res.headers.get("Last-Modified-Version", 0))
+
+        async def objects():
+            if not changed:
+                return []
+            params = {"since": since}
+            if scope == ITEMS:
+                params["includeTrashed"] = 1
+            return await zotero_aget_all(f"/{self.lib_path}/{scope}", headers=headers, params=params)
+
+        return await asyncio.gather(objects(), deleted())
+
+    def _set_version(self, conn, scope, new_version):
+        conn.execute(
+            "INSERT INTO meta (name, value) VALUES (?, ?) ON CONFLICT (name) "
+            "DO UPDATE SET value = MAX(CAST(value AS INTEGER), CAST(excluded.value AS INTEGER))",
+            (f"{scope}_version", new_version)
+        )
+
+    def _apply_collections(self, collections, deleted, deleted_version, new_version):
+        """
+        Upsert changed collections and tombstone deleted ones. A row is only
+        overwritten by a newer version, so a slower worker applying an older
+        listing cannot undo a newer change or deletion.
+        """
+        conn = self._db()
+        with conn:
+            conn.executemany(
+                "INSERT INTO collections (key, version, deleted, data) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET "
+                "version = excluded.version, deleted = excluded.deleted, data = excluded.data "
+                "WHERE excluded.version > collections.version",
+                [
+                    (c["key"], c["version"], int(bool(c["data"].get("deleted"))), json.dumps(c))
+                    for c in collections
+                ] + [(k, deleted_version, 0, None) for k in deleted]
+            )
+            self._set_version(conn, COLLECTIONS, new_version)
+
+    def _apply_items(self, items, deleted, deleted_version, new_version, notes):
+        """
+        Upsert changed items and tombstone deleted ones, newer versions only
+        (see _apply_collections), keeping item_collections in step. The
+        NOTES version only advances when the listing included notes.
+        """
+        conn = self._db()
+        with conn:
+            # Taking the next change number is the first write, so it holds
+            # the write lock and change numbers commit in order
+            conn.execute(
+                "INSERT INTO meta (name, value) VALUES ('changed', 1) "
+                "ON CONFLICT (name) DO UPDATE SET value = CAST(value AS INTEGER) + 1"
+            )
+            changed = int(conn.execute("SELECT value FROM meta WHERE name = 'changed'").fetchone()[0])
+            rows = [
+                (
+                    i["key"], i["version"], i["data"].get("itemType"), i["data"].get("parentItem"),
+                    int(bool(i["data"].get("deleted"))), i["data"].get("dateModified"),
+                    _search_text(i["data"]), json.dumps(i), changed, i["data"].get("collections", [])
+                )
+                for i in items
+            ] + [(k, deleted_version, None, None, 0, None, None, None, changed, []) for k in deleted]
+            for *row, collection_keys in rows:
+                applied = conn.execute(
+                    "INSERT INTO items "
+                    "(key, version, item_type, parent_item, deleted, date_modified, search_text, data, changed) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (key) DO UPDATE SET "
+                    "version = excluded.version, item_type = excluded.item_type, "
+                    "parent_item = excluded.parent_item, deleted = excluded.deleted, "
+                    "date_modified = excluded.date_modified, search_text = excluded.search_text, "
+                    "data = excluded.data, changed = excluded.changed "
+                    "WHERE excluded.version > items.version",
+                    row
+                ).rowcount
+                if applied:
+                    conn.execute("DELETE FROM item_collections WHERE item_key = ?", (row[0],))
+                    conn.executemany(
+                        "INSERT OR IGNORE INTO item_collections (item_key, collection_key) VALUES (?, ?)",
+                        [(row[0], c) for c in collection_keys]
+                    )
+            self._set_version(conn, ITEMS, new_version)
+            if notes:
+                self._set_version(conn, NOTES, new_version)
+
+    def collections(self):
+        """
+        Return the library's collections as Zotero collection objects.
+        """
+        rows = self._db().execute("SELECT data FROM collections WHERE data IS NOT NULL AND NOT deleted")
+        return [json.loads(data) for (data,) in rows]
+
+    def _items(self, where="", args=(), limit=None):
+        sql = f"SELECT data FROM items WHERE data IS NOT NULL AND NOT deleted {where} ORDER BY date_modified DESC"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        return [json.loads(data) for (data,) in self._db().execute(sql, args)]
+
+    def items(self, collection_keys=None, item_types=None, exclude_types=None, limit=None):
+        """
+        Return items, newest modification first, optionally only those in any
+        of collection_keys and of (or not of) the given item types.
+        """
+        where, args = [], []
+        if collection_keys is not None:
+            where.append(
+                "AND key IN (SELECT item_key FROM item_collections "
+                "WHERE collection_key IN (SELECT value FROM json_each(?)))"
+            )
+            args.append(json.dumps(list(collection_keys)))
+        if item_types:
+            where.append("AND item_type IN (SELECT value FROM json_each(?))")
+            args.append(json.dumps(list(item_types)))
+        if exclude_types:
+            where.append("AND item_type NOT IN (SELECT value FROM json_each(?))")
+            args.append(json.dumps(list(exclude_types)))
+        return self._items(" ".join(where), args, limit)
+
+    def items_by_key(self, keys):
+        """
+        Return the items with the given keys, in that order, skipping keys
+        that are missing or deleted.
+        """
+        rows = self._db().execute(
+            "SELECT key, data FROM items WHERE data IS NOT NULL AND NOT deleted "
+            "AND key IN (SELECT value FROM json_each(?))",
+            (json.dumps(list(keys)),)
+        )
+        found = {key: data for key, data in rows}
+        return [json.loads(found[key]) for key in keys if key in found]
+
+    def metadata_index(self):
+        """
+        Return this worker's MetadataIndex of the library's items, after
+        feeding it the rows written since it last caught up. Only the
+        indexed fields are read, straight from SQLite, so catching up costs
+        in proportion to what changed.
+        """
+        index = get_metadata_index(self.lib_path)
+        with index.feed_lock:
+            rows = self._db().execute(
+                "SELECT key, version, item_type, date_modified, data IS NULL OR deleted, changed, "
+                "json_extract(data, '$.data.title'), json_extract(data, '$.data.abstractNote'), "
+                "(SELECT group_concat(COALESCE(NULLIF(json_extract(value, '$.lastName'), ''), "
+                "json_extract(value, '$.name'), ''), ' ') FROM json_each(data, '$.data.creators')) "
+                "FROM items WHERE changed > ? ORDER BY changed",
+                (index.fed_through,)
+            )
+            for key, version, item_type, modified, gone, changed, title, abstract, creators in rows:
+                if gone:
+                    index.remove(key)
+                else:
+                    index.add_fields(key, version, item_type, modified, {
+                        "title": title or "", "creators": creators or "", "abstractNote": abstract or ""
+                    })
+                index.fed_through = changed
+        return index
+
+    def children(self, parent_keys, item_type=None):
+        """
+        Return the child items (attachments, notes) of the given parent items.
+        """
+        where = "AND parent_item IN (SELECT value FROM json_each(?))"
+        args = [json.dumps(list(parent_keys))]
+        if item_type:
+            where += " AND item_type = ?"
+            args.append(item_type)
+        return self._items(where, args)
+
+    def search(self, q, collection_keys=None, exclude_types=None, limit=None):
+        """
+        Quick search like Zotero's qmode=titleCreatorYear: every word of q
+        must occur in an item's title, creator names or year.
+        """
+        where, args = [], []
+        for word in (q or "").lower().split():
+            where.append("AND search_text LIKE ? ESCAPE '\\'")
+            args.append(_like_pattern(word))
+        if collection_keys is not None:
+            where.append(
+                "AND key IN (SELECT item_key FROM item_collections "
+                "WHERE collection_key IN (SELECT value FROM json_each(?)))"
+            )
+            args.append(json.dumps(list(collection_keys)))
+        if exclude_types:
+            where.append("AND item_type NOT IN (SELECT value FROM json_each(?))")
+            args.append(json.dumps(list(exclude_types)))
+        return self._items(" ".join(where), args, limit)
+
+
+_mirrors = {}
+_mirrors_lock = threading.Lock()
+
+
+def get_mirror(lib_path):
+    with _mirrors_lock:
+        mirror = _mirrors.get(lib_path)
+        if mirror is None:
+            mirror = _mirrors[lib_path] = LibraryMirror(lib_path)
+        return mirror
+
+
+def synced_mirror(lib_path, headers, scope=ITEMS, notes=False):
+    """
+    Return the mirror for lib_path after bringing scope (COLLECTIONS or
+    ITEMS) up to date; see LibraryMirror.sync for notes.
+    """
+    mirror = get_mirror(lib_path)
+    mirror.sync(headers, scope, notes)
+    return mirror
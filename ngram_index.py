@@ -0,0 +1,360 @@
+"""
+Trigram indexes for fuzzy matching on titles, creators, abstracts and
+collection paths.
+
+Text is normalized (lowercased, punctuation collapsed to spaces) and split
+into word trigrams padded the way PostgreSQL's pg_trgm does ("  w", " wo",
+"wor", "ord", "rd "). A query is answered by walking only the postings of
+its own trigrams, so the cost depends on how common the query's trigrams
+are rather than on how many documents are indexed.
+
+Two kinds of index are used:
+- TrigramIndex scores whole short strings (titles, collection paths) by the
+  Dice coefficient of their trigram sets, comparable to difflib's ratio;
+- WordIndex maps each distinct word to the documents containing it and keeps
+  a TrigramIndex over the vocabulary, so a query word also finds misspelled
+  or longer forms of itself ("sensemakng", "lab" -> "labs") in long fields
+  such as abstracts without indexing every trigram of every abstract.
+
+Item metadata indexes are kept per library and shared across requests;
+an item is only re-indexed when its Zotero version changes. A library's
+index is also fed incrementally from its local mirror (see
+LibraryMirror.metadata_index), so a search over the whole library can query
+it directly without loading every item.
+"""
+import math
+import os
+import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+from fulltext_search import STOPWORDS
+
+
+METADATA_INDEX_LIBRARIES = int(os.environ.get("METADATA_INDEX_LIBRARIES", "64"))
+
+_NON_WORD_RE = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def normalize(text):
+    return _NON_WORD_RE.sub(" ", text.lower()).strip()
+
+
+@lru_cache(maxsize=65536)
+def _word_trigrams(word):
+    padded = f"  {word} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def trigrams(text):
+    return frozenset().union(*map(_word_trigrams, normalize(text).split()))
+
+
+class TrigramIndex:
+    def __init__(self):
+        self.postings = {}  # trigram -> list of doc ids
+        self.grams = {}     # doc id -> frozenset of trigrams
+
+    def __len__(self):
+        return len(self.grams)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.grams
+
+    def add(self, doc_id, text):
+        self.remove(doc_id)
+        grams = trigrams(text or "")
+        self.grams[doc_id] = grams
+        postings = self.postings
+        for gram in grams:
+            docs = postings.get(gram)
+            if docs is None:
+                postings[gram] = [doc_id]
+            else:
+                docs.append(doc_id)
+
+    def remove(self, doc_id):
+        for gram in self.grams.pop(doc_id, ()):
+            docs = self.postings[gram]
+            docs.remove(doc_id)
+            if not docs:
+                del self.postings[gram]
+
+    def scores(self, query, containment=False, candidates=None):
+        """
+        Return {doc id: score} for every document sharing a trigram with the
+        query, optionally restricted to the doc ids in candidates. The score
+        is the Dice similarity, or with containment the share of the query's
+        trigrams found in the document.
+        """
+        query_grams = trigrams(query)
+        if not query_grams:
+            return {}
+        shared = {}
+        for gram in query_grams:
+            for doc_id in self.postings.get(gram, ()):
+                shared[doc_id] = shared.get(doc_id, 0) + 1
+        if candidates is not None:
+            shared = {d: c for d, c in shared.items() if d in candidates}
+        if containment:
+            return {d: c / len(query_grams) for d, c in shared.items()}
+        return {d: 2 * c / (len(query_grams) + len(self.grams[d])) for d, c in shared.items()}
+
+    def search(self, query, n=3, cutoff=0.4, containment=False, candidates=None):
+        """
+        Return up to n (doc id, score) pairs scoring at least cutoff, best first.
+        """
+        scored = self.scores(query, containment, candidates)
+        hits = [(d, s) for d, s in scored.items() if s >= cutoff]
+        hits.sort(key=lambda hit: hit[1], reverse=True)
+        return hits[:n]
+
+
+class WordIndex:
+    def __init__(self):
+        self.vocabulary = TrigramIndex()  # word -> its own trigrams
+        self.postings = {}                # word -> list of doc ids
+        self.words = {}                   # doc id -> frozenset of words
+
+    def add(self, doc_id, text):
+        self.remove(doc_id)
+        words = frozenset(normalize(text or "").split())
+        self.words[doc_id] = words
+        for word in words:
+            docs = self.postings.get(word)
+            if docs is None:
+                self.postings[word] = [doc_id]
+                self.vocabulary.add(word, word)
+            else:
+                docs.append(doc_id)
+
+    def remove(self, doc_id):
+        for word in self.words.pop(doc_id, ()):
+            docs = self.postings[word]
+            docs.remove(doc_id)
+            if not docs:
+                del self.postings[word]
+                self.vocabulary.remove(word)
+
+    def word_scores(self, word, cutoff, candidates=None):
+        """
+        Return {doc id: best containment of word in any of the doc's words}.
+        """
+        best = {}
+        for vocab_word, score in self.vocabulary.scores(word, containment=True).items():
+            if score < cutoff:
+                continue
+            for doc_id in self.postings[vocab_word]:
+                if score > best.get(doc_id, 0) and (candidates is None or doc_id in candidates):
+                    best[doc_id] = score
+        return best
+
+
+class MetadataIndex:
+    """
+    Indexes over one library's item titles, creator names and abstracts,
+    keyed by item key.
+    """
+    FIELDS = ("title", "creators", "abstractNote")
+    SIMILARITY_FIELDS = ("title", "creators")
+    # How much a query word counts when found in each field
+    FIELD_WEIGHTS = {"title": 3.0, "creators": 2.0, "abstractNote": 1.0}
+
+    def __init__(self):
+        self.similarity = {field: TrigramIndex() for field in self.SIMILARITY_FIELDS}
+        self.words = {field: WordIndex() for field in self.FIELDS}
+        self.versions = {}
+        self.item_types = {}
+        self.modified = {}
+        # Change number of the library mirror's rows fed so far (see
+        # LibraryMirror.metadata_index), and the lock held while feeding
+        self.fed_through = 0
+        self.feed_lock = threading.Lock()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.versions)
+
+    def add_items(self, items):
+        """
+        Index (or re-index) items from a Zotero listing; unchanged versions
+        are skipped.
+        """
+        with self._lock:
+            for item in items:
+                key = item.get("key")
+                data = item.get("data", {})
+                if key:
+                    self._add(
+                        key, item.get("version", data.get("version")), data.get("itemType"),
+                        data.get("dateModified", ""), {field: field_text(data, field) for field in self.FIELDS}
+                    )
+
+    def add_fields(self, key, version, item_type, modified, texts):
+        """
+        Index (or re-index) one item given its field texts.
+        """
+        with self._lock:
+            self._add(key, version, item_type, modified, texts)
+
+    def _add(self, key, version, item_type, modified, texts):
+        if key in self.versions and self.versions[key] == version:
+            return
+        self.versions[key] = version
+        self.item_types[key] = item_type
+        self.modified[key] = modified or ""
+        for field in self.FIELDS:
+            text = texts.get(field, "")
+            self.words[field].add(key, text)
+            if field in self.similarity:
+                self.similarity[field].add(key, text)
+
+    def remove(self, item_key):
+        with self._lock:
+            self.versions.pop(item_key, None)
+            self.item_types.pop(item_key, None)
+            self.modified.pop(item_key, None)
+            for index in (*self.similarity.values(), *self.words.values()):
+                index.remove(item_key)
+
+    def similar(self, query, field="title", n=3, cutoff=0.4, candidates=None, exclude_types=()):
+        """
+        Return up to n (item key, similarity) pairs for items (not of
+        exclude_types) whose whole field value resembles query, best first.
+        """
+        with self._lock:
+            if not exclude_types:
+                return self.similarity[field].search(query, n, cutoff, candidates=candidates)
+            hits = self.similarity[field].search(query, None, cutoff, candidates=candidates)
+            return [hit for hit in hits if self.item_types.get(hit[0]) not in exclude_types][:n]
+
+    def match_words(self, query, fields=FIELDS, cutoff=0.75, candidates=None):
+        """
+        Return (item key, score) pairs, best first, for items in which the
+        query's words occur across the given fields. Each query word scores
+        its best match in any field; an item's score is the average over
+        query words, so every word has to be (nearly) present.
+        """
+        query_words = list(dict.fromkeys(normalize(query).split()))
+        if not query_words:
+            return []
+        totals = {}
+        with self._lock:
+            for word in query_words:
+                best = {}
+                for field in fields:
+                    for key, score in self.words[field].word_scores(word, cutoff, candidates).items():
+                        if score > best.get(key, 0):
+                            best[key] = score
+                for key, score in best.items():
+                    totals[key] = totals.get(key, 0) + score
+        hits = [(k, t / len(query_words)) for k, t in totals.items() if t / len(query_words) >= cutoff]
+        hits.sort(key=lambda hit: hit[1], reverse=True)
+        return hits
+
+    def rank_terms(self, query, fields=FIELDS, cutoff=0.75, candidates=None, min_share=0.5, exclude_types=()):
+        """
+        Score items against all query words (stopwords aside) in one pass.
+        Returns (item key, (words matched, weighted score)) pairs, best first
+        and newest first among equals, for every item not of exclude_types
+        matching at least min_share of the words. Each word counts once, in
+        its best field, as the field's weight times how closely it matched,
+        scaled by how rare the word is among the items.
+        """
+        words = [w for w in dict.fromkeys(normalize(query).split()) if w not in STOPWORDS]
+        min_words = max(1, math.ceil(min_share * len(words)))
+        hits = {}  # item key -> [words matched, weighted score]
+        with self._lock:
+            for word in words:
+                best = {}
+                for field in fields:
+                    weight = self.FIELD_WEIGHTS.get(field, 1.0)
+                    for key, score in self.words[field].word_scores(word, cutoff, candidates).items():
+                        if weight * score > best.get(key, 0):
+                            best[key] = weight * score
+                n_items = len(candidates) if candidates is not None else len(self.versions)
+                idf = math.log(1 + n_items / (len(best) or 1))
+                for key, score in best.items():
+                    entry = hits.setdefault(key, [0, 0.0])
+                    entry[0] += 1
+                    entry[1] += score * idf
+            ranked = [
+                (key, tuple(entry)) for key, entry in hits.items()
+                if entry[0] >= min_words and self.item_types.get(key) not in exclude_types
+            ]
+            ranked.sort(key=lambda hit: (hit[1], self.modified.get(hit[0], "")), reverse=True)
+        return ranked
+
+
+def field_text(data, field):
+    if field == "creators":
+        return " ".join(
+            c.get("lastName") or c.get("name", "") for c in data.get("creators", [])
+        )
+    return str(data.get(field) or "")
+
+
+def item_library_path(item):
+    library = item.get("library") or {}
+    if library.get("type") and library.get("id") is not None:
+        return f"{library['type']}s/{library['id']}"
+    return "unknown"
+
+
+_metadata_indexes = OrderedDict()
+_metadata_lock = threading.Lock()
+
+
+def get_metadata_index(lib_path):
+    """
+    Return the shared metadata index for a library, keeping the
+    METADATA_INDEX_LIBRARIES most recently used ones.
+    """
+    with _metadata_lock:
+        index = _metadata_indexes.get(lib_path)
+        if index is None:
+            index = _metadata_indexes[lib_path] = MetadataIndex()
+        _metadata_indexes.move_to_end(lib_path)
+        while len(_metadata_indexes) > METADATA_INDEX_LIBRARIES:
+            _metadata_indexes.popitem(last=False)
+        return index
+
+
+def _rank_items(items, search):
+    """
+    Index items into their libraries' shared metadata indexes and rank them
+    with search(index, candidates), which returns (item key, score) pairs
+    with comparable scores. Returns the matching items, best first; ties
+    keep the listing's order.
+    """
+    by_library = {}
+    for item in items:
+        by_library.setdefault(item_library_path(item), []).append(item)
+    position = {id(item): i for i, item in enumerate(items)}
+
+    scored = []
+    for lib_path, lib_items in by_library.items():
+        index = get_metadata_index(lib_path)
+        index.add_items(lib_items)
+        by_key = {item.get("key"): item for item in lib_items}
+        for key, score in search(index, by_key):
+            scored.append((score, -position[id(by_key[key])], by_key[key]))
+    scored.sort(key=lambda hit: hit[:2], reverse=True)
+    return [item for _, _, item in scored]
+
+
+def similar_items(items, query, field="title", n=3, cutoff=0.4):
+    """
+    Return up to n items whose field value most resembles query.
+    """
+    return _rank_items(items, lambda index, keys: index.similar(query, field, n, cutoff, keys))[:n]
+
+
+def items_matching_words(items, query, fields=MetadataIndex.FIELDS, cutoff=0.75):
+    """
+    Return the items containing (close forms of) every word of query in
+    the given fields, best first.
+    """
+    return _rank_items(items, lambda index, keys: index.match_words(query, fields, cutoff, keys))
+
@@ -0,0 +1,155 @@
+"""
+Isolated worker processes for CPU-heavy document parsing.
+
+Each job runs in a separate, spawned process, so a pathological PDF can
+neither pin a web worker's thread nor grow its memory:
+
+- a job that exceeds its wall-clock timeout has its process killed,
+- each process runs under an address-space limit, so runaway allocations
+  fail with MemoryError inside the worker instead of in the web worker,
+- a process is replaced after max_jobs jobs, or once its peak RSS passes
+  recycle_rss_mb, so fragmentation and leaks do not accumulate.
+
+Jobs are plain (function, args) pairs; the function must be importable at
+module level so the spawned process can unpickle it.
+"""
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from worker_local import ProcessLocal
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+logger = logging.getLogger(__name__)
+
+
+class ParseError(Exception):
+    pass
+
+
+def _worker_main(conn, max_memory_bytes):
+    if resource and max_memory_bytes:
+        resource.setrlimit(resource.RLIMIT_AS, (max_memory_bytes, max_memory_bytes))
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if job is None:
+            return
+        fn, args = job
+        try:
+            reply = (True, fn(*args))
+        except BaseException as e:
+            reply = (False, f"{type(e).__name__}: {e}")
+        peak_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else 0
+        try:
+            conn.send((*reply, peak_rss_kb))
+        except Exception as e:
+            conn.send((False, f"Could not return result: {e}", peak_rss_kb))
+
+
+class _Worker:
+    def __init__(self, context, max_memory_bytes):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main, args=(child_conn, max_memory_bytes), daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+
+    def stop(self, kill=False):
+        try:
+            if kill:
+                self.process.kill()
+            else:
+                self.conn.send(None)
+            self.process.join(timeout=1)
+            if self.process.is_alive():
+                self.process.kill()
+        except Exception:
+            pass
+        self.conn.close()
+
+
+class ParsePool:
+    def __init__(self, workers, timeout, max_jobs=50, max_memory_mb=1024, recycle_rss_mb=512):
+        self.workers = workers
+        self.timeout = timeout
+        self.max_jobs = max_jobs
+        self.max_memory_bytes = max_memory_mb * 1024 * 1024 if max_memory_mb else None
+        self.recycle_rss_kb = recycle_rss_mb * 1024 if recycle_rss_mb else None
+        self._context = multiprocessing.get_context("spawn")
+        # One dispatcher thread per worker process; each thread owns its process
+        self._dispatch = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="parse-dispatch")
+        self._local = threading.local()
+
+    def submit(self, fn, *args, timeout=None):
+        """
+        Run fn(*args) in a worker process; returns a concurrent.futures.Future.
+        The future raises TimeoutError if the job ran longer than timeout
+        seconds, or ParseError if it failed or its worker died.
+        """
+        return self._dispatch.submit(self._run, fn, args, timeout or self.timeout)
+
+    def run(self, fn, *args, timeout=None):
+        return self.submit(fn, *args, timeout=timeout).result()
+
+    def _run(self, fn, args, timeout):
+        worker = getattr(self._local, "worker", None)
+        if worker is None or not worker.process.is_alive():
+            worker = self._local.worker = _Worker(self._context, self.max_memory_bytes)
+
+        worker.jobs += 1
+        try:
+            worker.conn.send((fn, args))
+            finished = worker.conn.poll(timeout)
+            if finished:
+                ok, value, peak_rss_kb = worker.conn.recv()
+        except (EOFError, OSError) as e:
+            self._retire(worker, kill=True)
+            raise ParseError(f"Parse worker died: {e}")
+        if not finished:
+            logger.warning(f"[ParsePool] Killing worker {worker.process.pid} after {timeout}s")
+            self._retire(worker, kill=True)
+            raise TimeoutError(f"Parsing took longer than {timeout}s")
+
+        if worker.jobs >= self.max_jobs or (self.recycle_rss_kb and peak_rss_kb > self.recycle_rss_kb):
+            self._retire(worker)
+        if not ok:
+            raise ParseError(value)
+        return value
+
+    def _retire(self, worker, kill=False):
+        self._local.worker = None
+        worker.stop(kill=kill)
+
+
+PDF_PARSE_WORKERS = int(os.environ.get("PDF_PARSE_WORKERS", str(os.cpu_count() or 2)))
+PDF_PARSE_TIMEOUT = float(os.environ.get("PDF_PARSE_TIMEOUT", "60"))
+PDF_PARSE_MAX_JOBS = int(os.environ.get("PDF_PARSE_MAX_JOBS", "50"))
+PDF_PARSE_MAX_MEMORY_MB = int(os.environ.get("PDF_PARSE_MAX_MEMORY_MB", "1024"))
+PDF_PARSE_RECYCLE_RSS_MB = int(os.environ.get("PDF_PARSE_RECYCLE_RSS_MB", "512"))
+
+_pool = ProcessLocal(lambda: ParsePool(
+    PDF_PARSE_WORKERS,
+    PDF_PARSE_TIMEOUT,
+    max_jobs=PDF_PARSE_MAX_JOBS,
+    max_memory_mb=PDF_PARSE_MAX_MEMORY_MB,
+    recycle_rss_mb=PDF_PARSE_RECYCLE_RSS_MB
+))
+
+
+def get_parse_pool():
+    """
+    Return this web worker process's parse pool, creating it on first use.
+    """
+    return _pool.get()
@@ -0,0 +1,436 @@
+"""
+PDF download and text extraction for Zotero attachments.
+
+extract_pdf_texts runs a pipeline for many attachments at once: downloads
+happen on a thread pool while PyMuPDF parsing runs in the isolated parse
+pool (see parse_pool.py), so network waits and CPU-bound parsing overlap
+instead of alternating. Single-document reads use the same parse pool, so
+fitz never runs inside a web worker. Results
+come back in the order the attachments were given. Attachments whose text
+is already in the on-disk text cache are neither downloaded nor parsed.
+
+Downloads are streamed into a size-capped in-memory buffer and opened by
+PyMuPDF straight from memory; nothing is written to a temp file. Concurrent
+downloads of the same file with the same key share one transfer.
+
+Full-document text keeps page boundaries as form feeds (PAGE_BREAK), so a
+cached document can still be read page by page. read_pdf_pages reads only
+as many pages as a character budget needs and returns a cursor to resume.
+
+Text sources are tried cheapest first: the local text cache, then Zotero's
+server-side full-text index (/items/{key}/fulltext), and only then the
+file download and PyMuPDF parse.
+"""
+import contextvars
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, TimeoutError, wait
+
+import fitz  # PyMuPDF
+
+from parse_pool import ParseError, get_parse_pool
+from single_flight import SingleFlight
+from text_cache import text_cache
+from worker_local import ProcessLocal
+from zotero_client import request_key, zotero_get
+
+
+logger = logging.getLogger(__name__)
+
+PDF_DOWNLOAD_WORKERS = int(os.environ.get("PDF_DOWNLOAD_WORKERS", "8"))
+# Seconds each document may spend being fetched, counted from when its
+# download starts; a slower download is aborted (parsing has its own limit,
+# enforced by the parse pool).
+PDF_DOC_TIMEOUT = float(os.environ.get("PDF_DOC_TIMEOUT", "60"))
+# Largest attachment we are willing to download and parse.
+PDF_MAX_BYTES = int(os.environ.get("PDF_MAX_BYTES", str(50 * 1024 * 1024)))
+# Downloaded files kept in memory so that continuing a read by cursor does
+# not download the PDF again: total bytes per worker, and seconds kept.
+PDF_RECENT_MAX_BYTES = int(os.environ.get("PDF_RECENT_MAX_BYTES", str(100 * 1024 * 1024)))
+PDF_RECENT_TTL = float(os.environ.get("PDF_RECENT_TTL", "600"))
+
+PAGE_BREAK = "\f"
+
+_downloads = ProcessLocal(
+    lambda: ThreadPoolExecutor(max_workers=PDF_DOWNLOAD_WORKERS, thread_name_prefix="pdf-download")
+)
+
+_file_flights = SingleFlight()
+
+
+class RecentFiles:
+    """
+    Small in-memory LRU of downloaded files, keyed by attachment key and
+    fingerprint, bounded in total bytes and entry age.
+    """
+    def __init__(self, max_bytes=PDF_RECENT_MAX_BYTES, ttl=PDF_RECENT_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries = OrderedDict()  # (key, fingerprint) -> (expires_at, data)
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, attachment_key, fingerprint):
+        if not fingerprint:
+            return None
+        with self._lock:
+            entry = self._entries.get((attachment_key, fingerprint))
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                self._pop((attachment_key, fingerprint))
+                return None
+            self._entries.move_to_end((attachment_key, fingerprint))
+            return entry[1]
+
+    def put(self, attachment_key, fingerprint, data):
+        if not fingerprint or len(data) > self.max_bytes:
+            return
+        with self._lock:
+            self._pop((attachment_key, fingerprint))
+            self._entries[(attachment_key, fingerprint)] = (time.monotonic() + self.ttl, data)
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                self._pop(next(iter(self._entries)))
+
+    def discard(self, attachment_key, fingerprint):
+        with self._lock:
+            self._pop((attachment_key, fingerprint))
+
+    def _pop(self, entry_key):
+        entry = self._entries.pop(entry_key, None)
+        if entry is not None:
+            self._size -= len(entry[1])
+
+
+recent_files = RecentFiles()
+
+
+class DownloadTimeout(TimeoutError):
+    pass
+
+
+class PdfTooLarge(Exception):
+    pass
+
+
+def parse_pdf_bytes(data):
+    """
+    Return the text of every page of a PDF given as bytes, pages separated
+    by PAGE_BREAK.
+    """
+    with fitz.open(stream=data, filetype="pdf") as doc:
+        return PAGE_BREAK.join(page.get_text() for page in doc)
+
+
+def get_fulltext(lib_path, item_key, headers):
+    """
+    Return Zotero's indexed full text for an attachment as (content, total_pages),
+    or None when the attachment is not indexed or only partially indexed.
+    """
+    try:
+        res = zotero_get(f"/{lib_path}/items/{item_key}/fulltext", headers=headers)
+        if res.status_code != 200:
+            return None
+        data = res.json()
+    except Exception as e:
+        logger.warning(f"[get_fulltext] Full-text lookup failed for {item_key}: {e}")
+        return None
+
+    content = data.get("content") or ""
+    if data.get("indexedPages", 0) < data.get("totalPages", 0):
+        return None
+    if data.get("indexedChars", 0) < data.get("totalChars", 0):
+        return None
+    if not content.strip():
+        return None
+    return content, data.get("totalPages")
+
+
+def get_fulltext_versions(lib_path, headers, since=0):
+    """
+    Return {attachment key: full-text version} for every attachment in the
+    library that Zotero has indexed full text for, in one request.
+    """
+    res = zotero_get(f"/{lib_path}/fulltext", headers=headers, params={"since": since})
+    if res.status_code != 200:
+        raise Exception(f"Zotero request failed ({res.status_code}) for /{lib_path}/fulltext")
+    return res.json()
+
+
+def parse_page_ranges(spec):
+    """
+    Parse a 1-based page selection such as "1-3,7,10-" into a list of
+    (first, last) ranges; last is None for an open-ended range.
+    Raises ValueError on malformed input.
+    """
+    ranges = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        first, sep, last = part.partition("-")
+        first = int(first) if first.strip() else 1
+        last = (int(last) if last.strip() else None) if sep else first
+        if first < 1 or (last is not None and last < first):
+            raise ValueError(f"Invalid page range '{part}'")
+        ranges.append((first, last))
+    if not ranges:
+        raise ValueError("Empty page range")
+    return ranges
+
+
+def _select_pages(ranges, page_count):
+    if not ranges:
+        return list(range(1, page_count + 1))
+    selected = set()
+    for first, last in ranges:
+        selected.update(range(first, min(last or page_count, page_count) + 1))
+    return sorted(selected)
+
+
+def _take_pages(get_page, selected, cursor, max_chars):
+    """
+    Collect text from the selected pages, starting at cursor (page, offset),
+    until max_chars characters are collected. Pages past that point are never
+    requested from get_page. Returns (chunks, next_cursor).
+    """
+    start_page, start_offset = cursor
+    chunks = []
+    used = 0
+    for n in selected:
+        if used >= max_chars:
+            return chunks, (n, 0)
+        page_text = get_page(n)
+        offset = start_offset if n == start_page else 0
+        piece = page_text[offset:offset + max_chars - used]
+        chunks.append(piece)
+        used += len(piece)
+        if offset + len(piece) < len(page_text):
+            return chunks, (n, offset + len(piece))
+    return chunks, None
+
+
+def read_pdf_bytes_pages(data, page_ranges, cursor, max_chars):
+    """
+    Parse-pool job: open a PDF from bytes and take pages as in _take_pages.
+    Returns (page_count, selected pages, chunks, next_cursor).
+    """
+    with fitz.open(stream=data, filetype="pdf") as doc:
+        selected = [n for n in _select_pages(page_ranges, doc.page_count) if n >= cursor[0]]
+        chunks, next_cursor = _take_pages(lambda n: doc[n - 1].get_text(), selected, cursor, max_chars)
+        return doc.page_count, selected, chunks, next_cursor
+
+
+def read_pdf_pages(lib_path, item_key, headers, fingerprint=None, page_ranges=None,
+                   cursor=(1, 0), max_chars=15000):
+    """
+    Read an attachment page by page until max_chars characters are collected.
+
+    Returns None if the file could not be downloaded, otherwise a dict with
+    "text", "page_count", "pages" ([first, last] page read), "next_cursor"
+    ((page, offset) to resume from, or None when done) and "source".
+    Pages after the budget is reached are never parsed. A cached document
+    is sliced from the cache instead of being downloaded. A partial read
+    keeps the file in recent_files for the continuation calls. The read that
+    reaches the end parses the whole file into the text cache in the
+    background.
+
+    Without a page selection, Zotero's full-text index is used when the file
+    is not cached. It has no page boundaries, so its whole content is read as
+    page 1 and cursors are offsets into it.
+    """
+    cached = text_cache.get(item_key, fingerprint)
+    fulltext = None
+    if cached is None and not page_ranges and cursor[0] == 1:
+        fulltext = get_fulltext(lib_path, item_key, headers)
+
+    if cached is not None or fulltext is not None:
+        source = "cache" if cached is not None else "zotero_fulltext"
+        page_texts = cached.split(PAGE_BREAK) if cached is not None else [fulltext[0]]
+        page_count = len(page_texts)
+        read = [n for n in _select_pages(page_ranges, page_count) if n >= cursor[0]]
+        chunks, next_cursor = _take_pages(lambda n: page_texts[n - 1], read, cursor, max_chars)
+    else:
+        source = "pdf"
+        data = recent_files.get(item_key, fingerprint) or download_pdf(lib_path, item_key, headers)
+        if data is None:
+            return None
+        page_count, read, chunks, next_cursor = get_parse_pool().run(
+            read_pdf_bytes_pages, data, page_ranges, cursor, max_chars
+        )
+        if next_cursor is None and read == list(range(1, page_count + 1)) and cursor[1] == 0:
+            # The whole document was read anyway, so cache it for next time
+            text_cache.put(item_key, fingerprint, PAGE_BREAK.join(chunks))
+            recent_files.discard(item_key, fingerprint)
+        elif next_cursor is None:
+            # A continued read reached the end: cache the whole text so no
+            # worker has to download this file again
+            recent_files.discard(item_key, fingerprint)
+            if fingerprint:
+                get_parse_pool().submit(parse_pdf_bytes, data).add_done_callback(
+                    lambda future: _cache_parsed(item_key, fingerprint, future)
+                )
+        else:
+            recent_files.put(item_key, fingerprint, data)
+
+    read = read[:len(chunks)]
+    return {
+        "text": "\n".join(chunks),
+        "page_count": fulltext[1] or page_count if fulltext else page_count,
+        "pages": [read[0], read[-1]] if read and not fulltext else [],
+        "next_cursor": next_cursor,
+        "source": source
+    }
+
+
+def _cache_parsed(item_key, fingerprint, future):
+    if future.exception() is not None:
+        logger.warning(f"[read_pdf_pages] Could not cache text of {item_key}: {future.exception()}")
+        return
+    text_cache.put(item_key, fingerprint, future.result())
+
+
+def download_pdf(lib_path, item_key, headers, max_bytes=PDF_MAX_BYTES, deadline=None):
+    """
+    Download an attachment file into memory, returning its bytes or None if
+    unavailable. Raises PdfTooLarge as soon as the file is known to exceed
+    max_bytes, from Content-Length or while streaming, and DownloadTimeout
+    once time.monotonic() passes deadline, closing the stream. Callers
+    downloading the same file at the same time share one download (and the
+    first caller's deadline; treat the bytes as read-only).
+    """
+    path = f"/{lib_path}/items/{item_key}/file"
+    return _file_flights.do(
+        (request_key(path, headers), max_bytes), _download, path, item_key, headers, max_bytes, deadline
+    )
+
+
+def _download(path, item_key, headers, max_bytes, deadline):
+    timed_out = DownloadTimeout(f"PDF {item_key} did not download in time")
+    timeout = None
+    if deadline is not None:
+        timeout = deadline - time.monotonic()
+        if timeout <= 0:
+            raise timed_out
+    res = zotero_get(path, headers=headers, stream=True, timeout=timeout)
+    try:
+        if res.status_code != 200:
+            logger.warning(f"[download_pdf] File not found or inaccessible: {path}")
+            return None
+
+        too_large = PdfTooLarge(f"PDF {item_key} is larger than the {max_bytes // (1024 * 1024)} MB limit")
+        length = res.headers.get("Content-Length")
+        if length and length.isdigit() and int(length) > max_bytes:
+            raise too_large
+
+        buf = bytearray()
+        try:
+            for chunk in res.iter_content(chunk_size=64 * 1024, deadline=deadline):
+                buf.extend(chunk)
+                if len(buf) > max_bytes:
+                    raise too_large
+        except TimeoutError:
+            raise timed_out from None
+        return buf
+    finally:
+        res.close()
+
+
+def _download_and_submit(job, headers, timeout):
+    deadline = time.monotonic() + timeout
+    cached = text_cache.get(job["key"], job.get("fingerprint"))
+    if cached is not None:
+        return cached
+    # "fulltext" is False when a bulk /fulltext listing showed no index for it
+    if job.get("fulltext") is not False:
+        fulltext = get_fulltext(job["lib_path"], job["key"], headers)
+        if fulltext is not None:
+            return fulltext[0]
+    data = download_pdf(job["lib_path"], job["key"], headers, deadline=deadline)
+    if not data:
+        return None
+    return get_parse_pool().submit(parse_pdf_bytes, data)
+
+
+def _collect(job, download_future, parse_future=None):
+    try:
+        if parse_future is None:
+            parse_future = download_future.result()  # the download enforces its own deadline
+            if parse_future is None:
+                return None
+            if isinstance(parse_future, str):
+                return parse_future.strip() or None  # cache or full-text index hit
+        text = parse_future.result()  # the parse pool enforces its own timeout
+        text_cache.put(job["key"], job.get("fingerprint"), text)
+        return text.strip() or None
+    except TimeoutError as e:
+        logger.error(f"[extract_pdf_texts] Timed out on {job['key']}: {e}")
+        return None
+    except ParseError as e:
+        logger.error(f"[extract_pdf_texts] Could not parse {job['key']}: {e}")
+        return None
+    except Exception as e:
+        logger.error(f"[extract_pdf_texts] Failed on {job['key']}: {e}")
+        return None
+
+
+def _completed(in_flight):
+    """
+    Wait until some of the in-flight futures finish, and yield (job, text)
+    for each job done. A finished download whose parse is still running
+    stays in flight as its parse future.
+    """
+    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+    for future in done:
+        job, download_future = in_flight.pop(future)
+        if future is download_future and future.exception() is None and isinstance(future.result(), Future):
+            in_flight[future.result()] = (job, download_future)
+        else:
+            yield job, _collect(job, download_future, None if future is download_future else future)
+
+
+def extract_pdf_texts(jobs, headers, timeout=PDF_DOC_TIMEOUT, max_in_flight=None, ordered=True):
+    """
+    Yield (job, text) for each job, in order, or as each finishes when
+    ordered is False; text is None when the PDF could not be downloaded,
+    parsed, or fetched within timeout seconds of its download starting.
+
+    Each job is a dict with at least "key" (the attachment key) and
+    "lib_path" (e.g. "users/123"), plus an optional "fingerprint" (see
+    text_cache.attachment_fingerprint) that enables caching and an optional
+    "fulltext" flag (False skips the full-text index lookup); any other
+    fields are passed through.
+    At most max_in_flight documents are downloaded or held for parsing at
+    once, which bounds memory use on large collections.
+    """
+    max_in_flight = max_in_flight or PDF_DOWNLOAD_WORKERS + get_parse_pool().workers
+    downloads = _downloads.get()
+
+    def submit(job):
+        # Downloads run in the caller's context so they keep its upstream priority
+        return downloads.submit(contextvars.copy_context().run, _download_and_submit, job, headers, timeout)
+
+    if not ordered:
+        in_flight = {}  # download or parse future -> (job, download future)
+        for job in jobs:
+            while len(in_flight) >= max_in_flight:
+                yield from _completed(in_flight)
+            future = submit(job)
+            in_flight[future] = (job, future)
+        while in_flight:
+            yield from _completed(in_flight)
+        return
+
+    pending = deque()
+    for job in jobs:
+        if len(pending) >= max_in_flight:
+            done_job, future = pending.popleft()
+            yield done_job, _collect(done_job, future)
+        pending.append((job, submit(job)))
+    while pending:
+        done_job, future = pending.popleft()
+        yield done_job, _collect(done_job, future)
@@ -0,0 +1,159 @@
+"""
+Per-API-key scheduling of upstream Zotero calls.
+
+Every upstream request first takes a token from its API key's bucket
+(ZOTERO_RATE_PER_KEY tokens per second, bursts of up to ZOTERO_RATE_BURST).
+When tokens run out, waiting calls are released in priority order, so
+interactive lookups (/items, /read_pdf, ...) overtake bulk work such as
+/summarize_collection. A Backoff or Retry-After header from Zotero pauses the
+whole key until the server's deadline has passed.
+
+The request's priority travels in the upstream_priority context variable:
+it is set per request in the web thread and carried into the upstream
+engine's tasks and into fan-out threads with the rest of the context.
+
+Schedulers live on the upstream engine's event loop and are only touched
+from it, so they need no locks.
+"""
+import asyncio
+import contextvars
+import heapq
+import itertools
+import os
+import random
+import time
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+
+from key_cache import hash_api_key
+
+
+RATE_PER_KEY = float(os.environ.get("ZOTERO_RATE_PER_KEY", "10"))
+RATE_BURST = float(os.environ.get("ZOTERO_RATE_BURST", "20"))
+MAX_SCHEDULERS = int(os.environ.get("ZOTERO_KEY_CACHE_SIZE", "1024"))
+
+# Retries of an idempotent GET after a 429/5xx or a transport error, and the
+# base and cap of the jittered exponential delay between attempts.
+MAX_RETRIES = int(os.environ.get("ZOTERO_MAX_RETRIES", "4"))
+RETRY_BASE_DELAY = float(os.environ.get("ZOTERO_RETRY_BASE_DELAY", "0.5"))
+RETRY_MAX_DELAY = float(os.environ.get("ZOTERO_RETRY_MAX_DELAY", "30"))
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# Longest a call waits for its key's turn before giving up with ZoteroRateLimited
+QUEUE_TIMEOUT = float(os.environ.get("ZOTERO_QUEUE_TIMEOUT", str(RETRY_MAX_DELAY)))
+
+INTERACTIVE = 0
+BULK = 1
+
+upstream_priority = contextvars.ContextVar("upstream_priority", default=INTERACTIVE)
+
+
+class ZoteroRateLimited(Exception):
+    def __init__(self, retry_after):
+        super().__init__(f"Zotero is rate limiting this API key; retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+def parse_delay(value):
+    """
+    Parse a Backoff/Retry-After header (seconds or an HTTP date) into seconds.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay(attempt):
+    """
+    Full-jitter exponential backoff for the given (0-based) retry attempt.
+    """
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+
+class KeyScheduler:
+    def __init__(self, rate=RATE_PER_KEY, burst=RATE_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._waiters = []  # heap of (priority, seq, future)
+        self._seq = itertools.count()
+        self._timer = None
+
+    def pause(self, seconds):
+        """
+        Hold back every call for this key for at least seconds.
+        """
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def remaining_pause(self):
+        return max(0.0, self.paused_until - time.monotonic())
+
+    async def acquire(self, priority=INTERACTIVE, timeout=QUEUE_TIMEOUT):
+        """
+        Wait for this key's next token. Raises ZoteroRateLimited at once when
+        the key is paused for longer than RETRY_MAX_DELAY, or when no token
+        comes within timeout seconds.
+        """
+        if self.remaining_pause() > RETRY_MAX_DELAY:
+            raise ZoteroRateLimited(self.remaining_pause())
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self._dispatch()
+        try:
+            await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            # wait_for cancelled the future, so _dispatch will skip it
+            raise ZoteroRateLimited(max(self.remaining_pause(), 1 / self.rate))
+
+    def _on_timer(self):
+        self._timer = None
+        self._dispatch()
+
+    def _dispatch(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+        while self._waiters and now >= self.paused_until and self.tokens >= 1:
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():  # the caller was cancelled while waiting
+                continue
+            self.tokens -= 1
+            future.set_result(None)
+
+        if self._waiters and self._timer is None:
+            wait = max(self.paused_until - now, (1 - self.tokens) / self.rate, 0.001)
+            self._timer = asyncio.get_running_loop().call_later(wait, self._on_timer)
+
+
+_schedulers = OrderedDict()
+_schedulers_pid = None
+
+
+def get_scheduler(headers):
+    """
+    Return the scheduler for the API key in headers (one shared scheduler
+    for unauthenticated calls). Must be called on the upstream loop.
+    """
+    global _schedulers_pid
+    if _schedulers_pid != os.getpid():
+        # Schedulers inherited through a fork belong to the parent's loop
+        _schedulers.clear()
+        _schedulers_pid = os.getpid()
+    api_key = (headers or {}).get("Zotero-API-Key")
+    digest = hash_api_key(api_key) if api_key else None
+    scheduler = _schedulers.get(digest)
+    if scheduler is None:
+        scheduler = _schedulers[digest] = KeyScheduler()
+    _schedulers.move_to_end(digest)
+    while len(_schedulers) > MAX_SCHEDULERS:
+        _schedulers.popitem(last=False)
+    return scheduler
@@ -0,0 +1,70 @@
+"""
+Single-flight coalescing of identical concurrent calls.
+
+While a call for some key is in flight, further callers with the same key
+do not start their own: they wait for the first one and share its result
+(or its exception). Nothing is cached once the call finishes, so a later
+caller always gets a fresh result.
+
+SingleFlight is for blocking calls made from many threads; AsyncSingleFlight
+is for coroutines on one event loop and is only touched from that loop.
+"""
+import asyncio
+import threading
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Return fn(*args, **kwargs), sharing one call among concurrent callers
+        with the same key.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+        else:
+            try:
+                call.result = fn(*args, **kwargs)
+            except BaseException as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+
+class AsyncSingleFlight:
+    def __init__(self):
+        self._tasks = {}
+
+    async def do(self, key, coro_fn, *args):
+        """
+        Await coro_fn(*args), sharing one task among concurrent callers with
+        the same key. A caller that is cancelled does not cancel the task for
+        the others.
+        """
+        task = self._tasks.get(key)
+        if task is None:
+            task = self._tasks[key] = asyncio.ensure_future(coro_fn(*args))
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        return await asyncio.shield(task)
@@ -0,0 +1,154 @@
+"""
+Tests for where extract_pdf_texts gets each document's text: Zotero's
+full-text index first, the PDF file when the index is partial, and straight
+to the file when the bulk /fulltext listing shows no index.
+
+Zotero is replaced by a local stand-in HTTP server serving canned responses.
+
+    python -m unittest discover -s tests
+"""
+import json
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+from urllib.parse import urlsplit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("PDF_TEXT_CACHE_DIR", tempfile.mkdtemp())
+
+import fitz  # noqa: E402
+
+import pdf_text  # noqa: E402
+import zotero_client  # noqa: E402
+
+HEADERS = {"Zotero-API-Key": "test-key"}
+
+
+def make_pdf(text):
+    doc = fitz.open()
+    doc.new_page().insert_text((72, 72), text)
+    data = doc.tobytes()
+    doc.close()
+    return data
+
+
+class StandInZotero(ThreadingHTTPServer):
+    """
+    Serves routes ({path: (status, content type, body bytes)}) on a free
+    local port and records every path requested.
+    """
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), _Handler)
+        self.routes = {}
+        self.requested = []
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def json(self, path, data, status=200):
+        self.routes[path] = (status, "application/json", json.dumps(data).encode("utf-8"))
+
+    def file(self, path, data):
+        self.routes[path] = (200, "application/pdf", data)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        self.server.requested.append(path)
+        status, content_type, body = self.server.routes.get(
+            path, (404, "application/json", b'{"error": "Not found"}')
+        )
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ExtractPdfTextsTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.zotero = StandInZotero()
+        cls.base_url = mock.patch.object(zotero_client, "ZOTERO_BASE_URL", cls.zotero.url)
+        cls.base_url.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.base_url.stop()
+        cls.zotero.stop()
+
+    def setUp(self):
+        self.zotero.routes.clear()
+        self.zotero.requested.clear()
+
+    def extract(self, *jobs):
+        return [text for _, text in pdf_text.extract_pdf_texts(list(jobs), HEADERS)]
+
+    def test_fully_indexed_attachment_is_read_from_the_fulltext_index(self):
+        self.zotero.json("/users/1/items/FULL1/fulltext", {
+            "content": "text from the full-text index",
+            "indexedPages": 3, "totalPages": 3
+        })
+        self.zotero.file("/users/1/items/FULL1/file", make_pdf("text from the file"))
+
+        texts = self.extract({"key": "FULL1", "lib_path": "users/1"})
+
+        self.assertEqual(texts, ["text from the full-text index"])
+        self.assertIn("/users/1/items/FULL1/fulltext", self.zotero.requested)
+        self.assertNotIn("/users/1/items/FULL1/file", self.zotero.requested)
+
+    def test_partially_indexed_attachment_falls_back_to_the_pdf(self):
+        self.zotero.json("/users/1/items/PART1/fulltext", {
+            "content": "only the first page",
+            "indexedPages": 1, "totalPages": 3
+        })
+        self.zotero.file("/users/1/items/PART1/file", make_pdf("text from the file"))
+
+        texts = self.extract({"key": "PART1", "lib_path": "users/1"})
+
+        self.assertEqual(len(texts), 1)
+        self.assertIn("text from the file", texts[0])
+        self.assertEqual(
+            self.zotero.requested, ["/users/1/items/PART1/fulltext", "/users/1/items/PART1/file"]
+        )
+
+    def test_bulk_listing_skips_the_lookup_for_unindexed_attachments(self):
+        self.zotero.json("/users/1/fulltext", {"IDX1": 12})
+        self.zotero.json("/users/1/items/IDX1/fulltext", {
+            "content": "indexed text", "indexedPages": 1, "totalPages": 1
+        })
+        self.zotero.file("/users/1/items/NOIDX1/file", make_pdf("unindexed text"))
+
+        versions = pdf_text.get_fulltext_versions("users/1", HEADERS)
+        self.assertEqual(versions, {"IDX1": 12})
+        texts = self.extract(
+            {"key": "IDX1", "lib_path": "users/1", "fulltext": "IDX1" in versions},
+            {"key": "NOIDX1", "lib_path": "users/1", "fulltext": "NOIDX1" in versions}
+        )
+
+        self.assertEqual(texts[0], "indexed text")
+        self.assertIn("unindexed text", texts[1])
+        self.assertNotIn("/users/1/items/NOIDX1/fulltext", self.zotero.requested)
+        self.assertIn("/users/1/items/NOIDX1/file", self.zotero.requested)
+        self.assertNotIn("/users/1/items/IDX1/file", self.zotero.requested)
+
+
+if __name__ == "__main__":
+    unittest.main()
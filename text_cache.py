@@ -0,0 +1,126 @@
+"""
+Persistent on-disk cache of text extracted from PDF attachments.
+
+Entries are addressed by the attachment key plus a fingerprint of the file
+(Zotero's attachment md5, or the item version when no md5 is known), so a
+changed file never serves stale text. Files are written to a temp name and
+renamed into place, which keeps reads safe while several gunicorn workers
+share the directory. Total size is bounded by evicting the least recently
+used entries (by mtime, which every hit refreshes).
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import zlib
+
+
+logger = logging.getLogger(__name__)
+
+TEXT_CACHE_DIR = os.environ.get(
+    "PDF_TEXT_CACHE_DIR", os.path.join(tempfile.gettempdir(), "zotero-gpt-text-cache")
+)
+TEXT_CACHE_MAX_BYTES = int(os.environ.get("PDF_TEXT_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+
+
+def attachment_fingerprint(data):
+    """
+    Return the cache fingerprint for an attachment's Zotero "data" dict,
+    or None when the attachment carries nothing that identifies its content.
+    """
+    if data.get("md5"):
+        return data["md5"]
+    if data.get("version"):
+        return f"v{data['version']}"
+    return None
+
+
+class TextCache:
+    def __init__(self, directory=TEXT_CACHE_DIR, max_bytes=TEXT_CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._written_since_evict = 0
+        self._lock = threading.Lock()
+
+    def _path(self, attachment_key, fingerprint):
+        digest = hashlib.sha256(f"{attachment_key}:{fingerprint}".encode("utf-8")).hexdigest()
+        return os.path.join(self.directory, digest[:2], f"{digest}.txt.z")
+
+    def get(self, attachment_key, fingerprint):
+        """
+        Return the cached text, or None on a miss.
+        """
+        if not fingerprint:
+            return None
+        path = self._path(attachment_key, fingerprint)
+        try:
+            with open(path, "rb") as f:
+                text = zlib.decompress(f.read()).decode("utf-8")
+            os.utime(path)
+            return text
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"[TextCache] Dropping unreadable entry {path}: {e}")
+            self._remove(path)
+            return None
+
+    def put(self, attachment_key, fingerprint, text):
+        if not fingerprint:
+            return
+        path = self._path(attachment_key, fingerprint)
+        payload = zlib.compress(text.encode("utf-8"))
+        try:
+            # Only the service's own user may read the cached text
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                f.write(payload)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"[TextCache] Could not write {path}: {e}")
+            return
+
+        # Only rescan the directory once roughly a tenth of the budget has
+        # been written since the last scan.
+        with self._lock:
+            self._written_since_evict += len(payload)
+            if self._written_since_evict < self.max_bytes // 10:
+                return
+            self._written_since_evict = 0
+        self.evict()
+
+    def evict(self):
+        """
+        Delete least recently used entries until the cache fits max_bytes.
+        """
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+text_cache = TextCache()
@@ -0,0 +1,211 @@
+"""
+TF-IDF theme extraction over a set of documents.
+
+Each document is tokenized once when it is added: unigram and bigram counts
+are taken with Counter over the token stream (bigrams spanning a stopword,
+number or short word are dropped) and the text itself is not kept, so a
+model's memory grows with distinct terms per document, not text size. When
+themes are requested, the counts form a sparse term-document matrix held as
+NumPy coordinate arrays, weighted with sublinear TF and smoothed IDF and
+L2-normalized per document.
+
+- Collection themes are the terms with the highest mean weight among those
+  appearing in at least two documents.
+- Document themes are the highest-weighted terms of each document that
+  occur there at least twice.
+
+Divergence works in a fixed-size vector space: terms are hashed into
+HASH_FEATURES buckets, so each document is a dense row of a small matrix
+regardless of vocabulary size. Documents are ranked by cosine distance to
+the collection centroid, and nearest neighbours come from the cosine
+similarity matrix, computed a block of rows at a time.
+"""
+import os
+import zlib
+from collections import Counter
+
+import numpy as np
+
+from fulltext_search import STOPWORDS, TOKEN_RE
+
+
+THEME_STOPWORDS = STOPWORDS | frozenset("""
+all any both each few most some only own same very just over under again further then once here
+there when where why how what who whom whose would could should might must will shall did does
+doing had having being about above below between through during before after out off up down
+one two three first second however therefore thus although though while because since within
+without upon across among per via et al fig figure figures table tables section sections
+chapter page pages pp vol ed eds doi http https www org com journal press university
+study studies paper article research results result analysis data using used use based
+found show shows shown well new many much even like also may might often given see
+""".split())
+
+MIN_WORD_LENGTH = 3
+
+HASH_FEATURES = int(os.environ.get("THEME_HASH_FEATURES", str(2 ** 14)))
+# Documents at least this many standard deviations further from the centroid
+# than average are reported as divergent
+DIVERGENCE_Z = float(os.environ.get("DIVERGENCE_Z", "1.0"))
+SIMILARITY_BLOCK = 256
+
+
+def _is_word(token):
+    return len(token) >= MIN_WORD_LENGTH and token.isalpha() and token not in THEME_STOPWORDS
+
+
+def document_terms(text):
+    """
+    Return {term: count} for the unigrams and bigrams of text.
+    """
+    tokens = TOKEN_RE.findall(text.lower())
+    unigrams = Counter(tokens)
+    bigrams = Counter(zip(tokens, tokens[1:]))
+
+    # Filtering distinct tokens and pairs is far cheaper than filtering the stream
+    terms = {t: c for t, c in unigrams.items() if _is_word(t)}
+    for (a, b), c in bigrams.items():
+        if c > 1 and a in terms and b in terms:
+            terms[f"{a} {b}"] = c
+    return terms
+
+
+class ThemeModel:
+    def __init__(self):
+        self.vocabulary = {}  # term -> column
+        self.terms = []       # column -> term
+        self.buckets = []     # column -> hashed feature
+        self._docs = []       # per document: (term columns, counts) as compact arrays
+
+    def __len__(self):
+        return len(self._docs)
+
+    def add_document(self, text):
+        """
+        Tokenize text and keep only its term counts. Returns the document's index.
+        """
+        counts = document_terms(text)
+        columns = np.empty(len(counts), dtype=np.int32)
+        for i, term in enumerate(counts):
+            column = self.vocabulary.get(term)
+            if column is None:
+                column = self.vocabulary[term] = len(self.terms)
+                self.terms.append(term)
+                self.buckets.append(zlib.crc32(term.encode("utf-8")) % HASH_FEATURES)
+            columns[i] = column
+        self._docs.append((columns, np.fromiter(counts.values(), dtype=np.uint32, count=len(counts))))
+        return len(self._docs) - 1
+
+    def weights(self):
+        """
+        Return the sparse TF-IDF matrix as coordinate arrays
+        (doc rows, term columns, raw counts, L2-normalized weights).
+        """
+        n_docs = len(self._docs)
+        rows = np.concatenate([np.full(len(cols), i, dtype=np.int64) for i, (cols, _) in enumerate(self._docs)])
+        cols = np.concatenate([cols for cols, _ in self._docs]).astype(np.int64)
+        counts = np.concatenate([counts for _, counts in self._docs]).astype(np.float64)
+
+        df = np.bincount(cols, minlength=len(self.terms))
+        idf = np.log((1 + n_docs) / (1 + df)) + 1
+        weights = (1 + np.log(counts)) * idf[cols]
+        norms = np.sqrt(np.bincount(rows, weights=weights ** 2, minlength=n_docs))
+        weights /= np.where(norms > 0, norms, 1)[rows]
+        return rows, cols, counts, weights
+
+    def themes(self, top_n=10, doc_top_n=5):
+        """
+        Return {"collection": [...], "documents": [[...], ...]} where each
+        list holds {"term", "weight"} dicts, strongest first.
+        """
+        n_docs = len(self._docs)
+        if not n_docs or not self.terms:
+            return {"collection": [], "documents": [[] for _ in range(n_docs)]}
+        rows, cols, counts, weights = self.weights()
+
+        # Collection: mean weight per term, over terms shared by at least two documents
+        mean = np.bincount(cols, weights=weights, minlength=len(self.terms)) / n_docs
+        if n_docs > 1:
+            mean[np.bincount(cols, minlength=len(self.terms)) < 2] = 0
+        top = np.argsort(-mean)[:top_n]
+        collection = [
+            {"term": self.terms[c], "weight": round(float(mean[c]), 4)} for c in top if mean[c] > 0
+        ]
+
+        # Documents: sort all entries by (doc, -weight) once, then take each doc's head
+        keep = counts >= 2
+        rows, cols, weights = rows[keep], cols[keep], weights[keep]
+        order = np.lexsort((-weights, rows))
+        rows, cols, weights = rows[order], cols[order], weights[order]
+        starts = np.searchsorted(rows, np.arange(n_docs))
+        ends = np.searchsorted(rows, np.arange(n_docs), side="right")
+        documents = [
+            [
+                {"term": self.terms[c], "weight": round(float(w), 4)}
+                for c, w in zip(cols[start:min(end, start + doc_top_n)], weights[start:min(end, start + doc_top_n)])
+            ]
+            for start, end in zip(starts, ends)
+        ]
+        return {"collection": collection, "documents": documents}
+
+    def hashed_vectors(self):
+        """
+        Return the documents as an (n_docs, HASH_FEATURES) float32 matrix of
+        hashed, L2-normalized TF-IDF weights.
+        """
+        n_docs = len(self._docs)
+        rows, cols, _, weights = self.weights()
+        vectors = np.zeros((n_docs, HASH_FEATURES), dtype=np.float32)
+        np.add.at(vectors, (rows, np.asarray(self.buckets, dtype=np.int64)[cols]), weights)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1)
+
+    def divergence(self, neighbours=3, z_threshold=DIVERGENCE_Z):
+        """
+        Return the documents whose content is furthest from the rest, most
+        divergent first, as dicts with "doc" (index), "distance" (cosine
+        distance to the centroid), "z_score" and "nearest" (the closest
+        other documents as {"doc", "similarity"}).
+        """
+        n_docs = len(self._docs)
+        if n_docs < 3 or not self.terms:
+            return []
+        vectors = self.hashed_vectors()
+
+        centroid = vectors.mean(axis=0)
+        centroid /= np.linalg.norm(centroid) or 1
+        distance = 1 - vectors @ centroid
+        spread = distance.std()
+        if spread == 0:
+            return []
+        z_scores = (distance - distance.mean()) / spread
+        divergent = np.flatnonzero(z_scores >= z_threshold)
+        divergent = divergent[np.argsort(-distance[divergent])]
+        if not len(divergent):
+            return []
+
+        # Similarities of the divergent documents to all others, in row blocks
+        k = min(neighbours, n_docs - 1)
+        nearest = np.empty((len(divergent), k), dtype=np.int64)
+        similarity = np.empty((len(divergent), k), dtype=np.float32)
+        for start in range(0, len(divergent), SIMILARITY_BLOCK):
+            block = divergent[start:start + SIMILARITY_BLOCK]
+            sims = vectors[block] @ vectors.T
+            sims[np.arange(len(block)), block] = -np.inf
+            top = np.argpartition(-sims, k - 1, axis=1)[:, :k]
+            top_sims = np.take_along_axis(sims, top, axis=1)
+            order = np.argsort(-top_sims, axis=1)
+            nearest[start:start + len(block)] = np.take_along_axis(top, order, axis=1)
+            similarity[start:start + len(block)] = np.take_along_axis(top_sims, order, axis=1)
+
+        return [
+            {
+                "doc": int(doc),
+                "distance": round(float(distance[doc]), 4),
+                "z_score": round(float(z_scores[doc]), 2),
+                "nearest": [
+                    {"doc": int(j), "similarity": round(float(sim), 4)}
+                    for j, sim in zip(nearest[i], similarity[i])
+                ]
+            }
+            for i, doc in enumerate(divergent)
+        ]
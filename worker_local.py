@@ -0,0 +1,60 @@
+"""
+State that belongs to one gunicorn worker process.
+
+Gunicorn forks its workers, and a forked child inherits neither the parent's
+threads nor safe use of its sockets and SQLite connections. ProcessLocal
+holds a lazily created object (a thread pool, an event loop) and creates a
+fresh one in each process that uses it; SqliteConnections does the same per
+thread for connections to one SQLite database.
+"""
+import os
+import sqlite3
+import threading
+
+
+class ProcessLocal:
+    def __init__(self, factory):
+        self._factory = factory
+        self._value = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def get(self):
+        """
+        Return this process's object, creating it on first use.
+        """
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._value = self._factory()
+                    self._pid = pid
+        return self._value
+
+
+class SqliteConnections:
+    def __init__(self, path, schema, row_factory=None, **connect_kwargs):
+        self.path = path
+        self.schema = schema
+        self.row_factory = row_factory
+        self.connect_kwargs = connect_kwargs
+        self._local = threading.local()
+
+    def get(self):
+        """
+        Return this thread's connection, opening it (and the schema) on first use.
+        Connections are never shared across threads or forked processes.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            # Databases hold library data: only the service's own user may read them
+            os.makedirs(os.path.dirname(self.path), mode=0o700, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30, **self.connect_kwargs)
+            if self.row_factory is not None:
+                conn.row_factory = self.row_factory
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(self.schema)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
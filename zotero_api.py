@@ -1,12 +1,23 @@
-from flask import Flask, request, jsonify, send_from_directory
-import requests
-import fitz  # PyMuPDF
+from flask import Flask, Response, request, jsonify, send_from_directory, stream_with_context, g, has_app_context
+import json
+import math
 import os
-from difflib import get_close_matches
 from flask_cors import CORS
-import tempfile
-import gc
 from flask import current_app as app  # for app.logger
+from zotero_client import get_headers, zotero_get, zotero_get_all, fan_out
+from rate_limit import BULK, INTERACTIVE, ZoteroRateLimited, upstream_priority
+from key_cache import key_cache
+from collection_index import CollectionIndex
+from library_mirror import COLLECTIONS, synced_mirror
+from ngram_index import similar_items, items_matching_words
+from pdf_text import (
+    extract_pdf_texts, get_fulltext_versions, read_pdf_pages, parse_page_ranges, PdfTooLarge
+)
+from text_cache import attachment_fingerprint, text_cache
+from parse_pool import ParseError
+from themes import ThemeModel
+from fulltext_search import get_library_index
+from jobs import get_job, submit_job
 
 import logging
 logging.basicConfig(level=logging.DEBUG)
@@ -22,138 +33,173 @@ logging.basicConfig(level=logging.DEBUG)
 
 app = Flask(__name__)
 CORS(app)
-ZOTERO_BASE_URL = "https://api.zotero.org"
 
+# Characters of PDF text returned per /read_pdf call; use next_cursor for more
+READ_PDF_MAX_CHARS = 15000
+# Most hits returned by /search_fulltext
+SEARCH_MAX_RESULTS = 50
+# How closely (share of trigrams) query words must occur in a multi-field match
+MULTI_FIELD_CUTOFF = 0.75
+# Most items returned by /items, and the share of the (non-stopword) query
+# words an item must match in its fallback search
+ITEMS_MAX_RESULTS = 100
+FALLBACK_MIN_SHARE = 0.5
+# Endpoints whose upstream calls yield to interactive lookups of the same key
+BULK_ENDPOINTS = {"summarize_collection"}
 
 
+@app.before_request
+def set_upstream_priority():
+    upstream_priority.set(BULK if request.endpoint in BULK_ENDPOINTS else INTERACTIVE)
 
 
+def error_response(e):
+    """
+    JSON error for an exception raised while serving a route. When Zotero is
+    still throttling the key, tell the caller when to come back.
+    """
+    if isinstance(e, ZoteroRateLimited):
+        return jsonify({"error": str(e)}), 503, {"Retry-After": str(math.ceil(e.retry_after))}
+    return jsonify({"error": str(e)}), 500
 
-# Helper to build auth headers
-def get_headers(api_key):
-    return {"Zotero-API-Key": api_key}
 
-# Get user ID
-def get_user_id(api_key):
+
+
+
+
+# Get user ID and key permissions (cached per hashed API key)
+def get_key_info(api_key, refresh=False):
+    """
+    Return the key's userID and access, from key_cache unless refresh is set.
+    """
+    cached = key_cache.get(api_key)
+    if not refresh and cached and "user_id" in cached:
+        return cached
+
     headers = get_headers(api_key)
-    res = requests.get(f"{ZOTERO_BASE_URL}/keys/current", headers=headers)
+    res = zotero_get("/keys/current", headers=headers)
     if res.status_code != 200:
+        key_cache.invalidate(api_key)
         raise Exception("Invalid API key or Zotero request failed")
-    return res.json()["userID"]
+    data = res.json()
+    info = {"user_id": data["userID"], "access": data.get("access", {})}
+    key_cache.update(api_key, **info)
+    return info
+
+
+def get_user_id(api_key):
+    return get_key_info(api_key)["user_id"]
 
-def suggest_alternatives(items, q, field="title", n=3):
+def notes_access(api_key, lib_path):
     """
-    Return up to n closest fuzzy matches as suggestions.
+    Whether the key may read notes in lib_path: group libraries share their
+    notes with every member, the personal library needs the notes permission.
     """
-    titles = [item.get("data", {}).get(field, "") for item in items]
-    matches = get_close_matches(q, titles, n=n, cutoff=0.4)
-    return matches
+    if lib_path.startswith("groups/"):
+        return True
+    return bool(get_key_info(api_key)["access"].get("user", {}).get("notes"))
+
+def get_user_groups(api_key, user_id, headers):
+    """
+    Return the groups the user belongs to, cached alongside the userID.
+    """
+    cached = key_cache.get(api_key)
+    if cached and "groups" in cached:
+        return cached["groups"]
+
+    groups = zotero_get_all(f"/users/{user_id}/groups", headers=headers)
+    key_cache.update(api_key, groups=groups)
+    return groups
+
+def suggest_alternatives(mirror, q, field="title", n=3):
+    """
+    Return up to n closest fuzzy matches among the mirror's regular items as suggestions.
+    """
+    hits = mirror.metadata_index().similar(q, field=field, n=n, exclude_types=("attachment", "note"))
+    return [item["data"].get(field, "") for item in mirror.items_by_key([key for key, _ in hits])]
 
 def fuzzy_match(items, query, key="title"):
     """
     Return a list of items whose 'key' field is a close match to the query.
     Preserves ordering by closeness.
     """
-    title_map = {item.get("data", {}).get(key, ""): item for item in items}
-    titles = list(title_map.keys())
-    matches = get_close_matches(query, titles, n=3, cutoff=0.4)
-    return [title_map[m] for m in matches]
+    return similar_items(items, query, field=key, n=3)
 
 def fuzzy_match_multi_field(items, query, keys=["title", "abstractNote", "creators"]):
     """
     Fuzzy match items by comparing the query against multiple fields.
+    Every query word has to occur, possibly misspelled, in one of the fields.
     """
-    matches = []
-    lowered_query = query.lower()
-
-    for item in items:
-        data = item.get("data", {})
-        combined = ""
-
-        for key in keys:
-            if key == "creators":
-                names = [creator.get("lastName", "") for creator in data.get("creators", [])]
-                combined += " ".join(names) + " "
-            else:
-                combined += str(data.get(key, "")) + " "
+    return items_matching_words(items, query, fields=keys, cutoff=MULTI_FIELD_CUTOFF)
 
-        if lowered_query in combined.lower():
-            matches.append(item)
 
-    return matches
 
 
 
 
+def get_collection_indexes(api_key, user_id, headers):
+    """
+    Return (indexes, group_errors): a CollectionIndex for the personal library
+    followed by one per group library, and {group name: error} for groups that
+    could not be fetched. Collections are read from each library's local
+    mirror after syncing its collections (not its items); libraries are
+    synced concurrently, and at most once per request.
+    """
+    if has_app_context() and "collection_indexes" in g:
+        return g.collection_indexes
 
+    libraries = [("user", user_id, "personal")]
+    for group in get_user_groups(api_key, user_id, headers):
+        gid = group.get("id")
+        libraries.append(("group", gid, group.get("name", f"group_{gid}")))
+
+    def fetch(library):
+        lib_type, lib_id, name = library
+        collections = synced_mirror(f"{lib_type}s/{lib_id}", headers, COLLECTIONS).collections()
+        return CollectionIndex(lib_type, lib_id, collections, name=name)
+
+    results = fan_out(fetch, libraries)
+
+    # Personal library failures fail the request; group failures are reported
+    personal, error = results[0]
+    if error:
+        raise error
+    indexes = [personal]
+    group_errors = {}
+    for (lib_type, lib_id, name), (index, error) in zip(libraries[1:], results[1:]):
+        if error:
+            app.logger.warning(f"[get_collection_indexes] Skipping group {lib_id}: {error}")
+            group_errors[name] = str(error)
+        else:
+            indexes.append(index)
+
+    if has_app_context():
+        g.collection_indexes = (indexes, group_errors)
+    return indexes, group_errors
 
 def get_collection_keys_by_name(api_key, user_id, name, headers):
     """
     Return all matching collection keys (including nested ones) by fuzzy matching on full_path.
     """
-    all_collections = []
-
-    # Personal
-    personal = requests.get(f"{ZOTERO_BASE_URL}/users/{user_id}/collections", headers=headers).json()
-    for col in personal:
-        col["library_type"] = "personal"
-    all_collections.extend(personal)
+    indexes, _ = get_collection_indexes(api_key, user_id, headers)
 
-    # Groups
-    groups = requests.get(f"{ZOTERO_BASE_URL}/users/{user_id}/groups", headers=headers).json()
-    for group in groups:
-        gid = group.get("id")
-        try:
-            group_colls = requests.get(
-                f"{ZOTERO_BASE_URL}/groups/{gid}/collections", headers=headers
-            ).json()
-            for col in group_colls:
-                col["library_type"] = f"group_{gid}"
-            all_collections.extend(group_colls)
-        except Exception:
-            continue
-
-    # Build full paths
-    id_to_collection = {c["data"]["key"]: c for c in all_collections}
-    def build_full_path(col):
-        parts = [col["data"]["name"]]
-        parent = col["data"].get("parentCollection")
-        while parent and parent in id_to_collection:
-            parent_col = id_to_collection[parent]
-            parts.insert(0, parent_col["data"]["name"])
-            parent = parent_col["data"].get("parentCollection")
-        return "/".join(parts)
-
-    full_paths = {build_full_path(c).lower(): c for c in all_collections}
-    matches = get_close_matches(name.lower(), full_paths.keys(), n=3, cutoff=0.4)
+    matches = []
+    for index in indexes:
+        matches.extend((score, index, key) for key, score in index.match_paths(name))
+    matches.sort(key=lambda m: m[0], reverse=True)
     if not matches:
         return []
 
-    matched_keys = {full_paths[m]["data"]["key"] for m in matches}
-
-    # Build parent-child map
-    parent_to_children = {}
-    for c in all_collections:
-        parent = c["data"].get("parentCollection")
-        if parent:
-            parent_to_children.setdefault(parent, []).append(c["data"]["key"])
-
-    def gather_all_children(keys):
-        result = set(keys)
-        for k in keys:
-            result.update(gather_all_children(parent_to_children.get(k, [])))
-        return result
-
     result = []
-    for key in gather_all_children(matched_keys):
-        col = id_to_collection.get(key)
-        if col:
-            lib_type = col["library_type"]
-            if lib_type in ["personal", "user"]:
-                result.append({"key": key, "library_type": "user", "library_id": user_id})
-            elif lib_type.startswith("group_"):
-                gid = int(lib_type.split("_")[1])
-                result.append({"key": key, "library_type": "group", "library_id": gid})
+    seen = set()
+    for _, index, key in matches[:3]:
+        for k in [key, *index.descendants(key)]:
+            if (index.library_id, k) not in seen:
+                seen.add((index.library_id, k))
+                result.append({
+                    "key": k, "path": index.full_path(k),
+                    "library_type": index.library_type, "library_id": index.library_id
+                })
     return result
 
 
@@ -172,10 +218,11 @@ def ping():
     if not api_key:
         return jsonify({"error": "Missing Zotero API key"}), 400
     try:
-        user_id = get_user_id(api_key)
+        # Always ask Zotero, so a revoked key is not reported as working
+        user_id = get_key_info(api_key, refresh=True)["user_id"]
         return jsonify({"status": "ok", "user_id": user_id})
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return error_response(e)
 
 
 
@@ -190,72 +237,28 @@ def get_all_collections():
 
     try:
         headers = get_headers(api_key)
-        user_info = requests.get(f"{ZOTERO_BASE_URL}/keys/current", headers=headers).json()
-        user_id = user_info["userID"]
-
-        def flatten_collections(collections, parent_id=None, prefix=""):
-            flat = []
-            for col in collections:
-                if col.get("parentCollection") == parent_id:
-                    full_name = f"{prefix}/{col['data']['name']}".strip("/")
-                    flat.append({
-                        "name": col["data"]["name"],
-                        "key": col["data"]["key"],
-                        "full_path": full_name,
-                        "parent_key": col["data"].get("parentCollection"),
-                        "library_type": "personal"
-                    })
-                    flat += flatten_collections(collections, col["data"]["key"], full_name)
-            return flat
+        user_id = get_user_id(api_key)
+
+        indexes, group_errors = get_collection_indexes(api_key, user_id, headers)
 
         # Personal collections
-        personal_raw = requests.get(
-            f"{ZOTERO_BASE_URL}/users/{user_id}/collections", headers=headers
-        ).json()
-        personal_flat = flatten_collections(personal_raw)
+        personal_flat = indexes[0].flatten("personal")
 
         # Group collections
         group_collections = []
-        groups = requests.get(
-            f"{ZOTERO_BASE_URL}/users/{user_id}/groups", headers=headers
-        ).json()
-
-        for group in groups:
-            group_id = group.get("id")
-            group_name = group.get("name", f"group_{group_id}")
-            try:
-                group_raw = requests.get(
-                    f"{ZOTERO_BASE_URL}/groups/{group_id}/collections", headers=headers
-                ).json()
-
-                def flatten_group(collections, parent_id=None, prefix="", group_name="unknown"):
-                    flat = []
-                    for col in collections:
-                        if col.get("parentCollection") == parent_id:
-                            full_name = f"{prefix}/{col['data']['name']}".strip("/")
-                            flat.append({
-                                "name": col["data"]["name"],
-                                "key": col["data"]["key"],
-                                "full_path": full_name,
-                                "parent_key": col["data"].get("parentCollection"),
-                                "library_type": group_name
-                            })
-                            flat += flatten_group(collections, col["data"]["key"], full_name, group_name)
-                    return flat
-
-                group_flat = flatten_group(group_raw, parent_id=None, prefix="", group_name=group_name)
-                group_collections.extend(group_flat)
-
-            except Exception:
-                continue  # skip groups that fail
+        for index in indexes[1:]:
+            group_collections.extend(index.flatten(index.name))
 
-        return jsonify({
+        response = {
             "personal_collections": personal_flat,
             "group_collections": group_collections
-        })
+        }
+        if group_errors:
+            response["group_errors"] = group_errors
+        return jsonify(response)
 
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return error_response(e)
 
 
 
@@ -299,57 +302,28 @@ def collection_tree_preview():
 
     try:
         headers = get_headers(api_key)
-        user_info = requests.get(f"{ZOTERO_BASE_URL}/keys/current", headers=headers).json()
-        user_id = user_info["userID"]
-
-        # Helper to build tree from flat collection list
-        def build_tree(collections):
-            tree = {}
-            by_key = {c["data"]["key"]: c["data"] for c in collections}
-            children_map = {}
-            for c in collections:
-                parent = c["data"].get("parentCollection")
-                children_map.setdefault(parent, []).append(c["data"]["key"])
-
-            def walk(key, level=0):
-                name = by_key[key]["name"]
-                indent = "  " * level
-                line = f"{indent}- {name}"
-                lines = [line]
-                for child_key in sorted(children_map.get(key, []), key=lambda k: by_key[k]["name"]):
-                    lines.extend(walk(child_key, level + 1))
-                return lines
-
-            # Get top-level keys (no parent)
-            top_keys = [k for k, v in by_key.items() if not v.get("parentCollection")]
-            output = []
-            for key in sorted(top_keys, key=lambda k: by_key[k]["name"]):
-                output.extend(walk(key))
-            return "\n".join(output)
+        user_id = get_user_id(api_key)
+
+        indexes, group_errors = get_collection_indexes(api_key, user_id, headers)
 
         # Personal collections
-        personal_raw = requests.get(f"{ZOTERO_BASE_URL}/users/{user_id}/collections", headers=headers).json()
-        personal_tree = build_tree(personal_raw)
+        personal_tree = indexes[0].render_tree()
 
         # Group collections
         group_trees = {}
-        groups = requests.get(f"{ZOTERO_BASE_URL}/users/{user_id}/groups", headers=headers).json()
-        for group in groups:
-            gid = group.get("id")
-            group_name = group.get("name", f"group_{gid}")
-            try:
-                group_raw = requests.get(f"{ZOTERO_BASE_URL}/groups/{gid}/collections", headers=headers).json()
-                group_trees[group_name] = build_tree(group_raw)
-            except Exception:
-                continue
+        for index in indexes[1:]:
+            group_trees[index.name] = index.render_tree()
 
-        return jsonify({
+        response = {
             "personal_collections_tree": personal_tree,
             "group_collections_tree": group_trees
-        })
+        }
+        if group_errors:
+            response["group_errors"] = group_errors
+        return jsonify(response)
 
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return error_response(e)
 
 
 
@@ -373,33 +347,22 @@ def search_items():
         user_id = get_user_id(api_key)
         headers = get_headers(api_key)
 
-        search_params = {
-            "format": "json",
-            "qmode": "titleCreatorYear",
-            "limit": 100
-        }
-
-        if q:
-            search_params["q"] = q
-
         # Enhanced: resolve full collection + subcollections
+        collection_keys = None
         if collection_name:
             if collection_name.startswith("collectionkey:"):
-                collection_key = collection_name.split(":", 1)[-1].strip()
-                search_params["collection"] = collection_key
+                collection_keys = [collection_name.split(":", 1)[-1].strip()]
             else:
                 collection_refs = get_collection_keys_by_name(api_key, user_id, collection_name, headers)
-                collection_keys = [ref["key"] for ref in collection_refs]
-                if collection_keys:
-                    search_params["collection"] = ",".join(collection_keys)
-
-        # Main search
-        item_res = requests.get(
-            f"{ZOTERO_BASE_URL}/users/{user_id}/items",
-            headers=headers,
-            params=search_params
+                collection_keys = [ref["key"] for ref in collection_refs] or None
+
+        # Main search, against the local mirror of the personal library
+        # Notes synced by a key with notes access stay hidden from keys without it
+        notes = notes_access(api_key, f"users/{user_id}")
+        mirror = synced_mirror(f"users/{user_id}", headers, notes=notes)
+        items = mirror.search(
+            q, collection_keys, exclude_types=None if notes else ("note",), limit=ITEMS_MAX_RESULTS
         )
-        items = item_res.json()
 
         if items:
             return jsonify([
@@ -413,17 +376,18 @@ def search_items():
                 for i in items
             ])
 
-        # Retry: broader search ignoring collection
+        # Retry: broader search over the whole library, ignoring collection
         if q:
-            broader_res = requests.get(
-                f"{ZOTERO_BASE_URL}/users/{user_id}/items",
-                headers=headers,
-                params={"format": "json", "limit": 100, "q": q, "qmode": "titleCreatorYear"}
+            # Score the library's items against all query words at once in
+            # the mirror's metadata index, ranking by how many words hit and
+            # whether they hit title, creators or abstract; only the top
+            # matches are read back from the mirror
+            hits = mirror.metadata_index().rank_terms(
+                q, cutoff=MULTI_FIELD_CUTOFF, min_share=FALLBACK_MIN_SHARE,
+                exclude_types=("attachment", "note")
             )
-            broader_items = broader_res.json()
-
-            fuzzy_hits = fuzzy_match_multi_field(broader_items, q)
-            if fuzzy_hits:
+            ranked = mirror.items_by_key([key for key, _ in hits[:ITEMS_MAX_RESULTS]])
+            if ranked:
                 return jsonify([
                     {
                         "title": i["data"].get("title", "Untitled"),
@@ -432,44 +396,18 @@ def search_items():
                         "creators": [c.get("lastName", "") for c in i["data"].get("creators", [])],
                         "abstract": i["data"].get("abstractNote", "")
                     }
-                    for i in fuzzy_hits
-                ])
-
-            # Final fallback: split query into words
-            keywords = q.split()
-            keyword_hits = []
-            for word in keywords:
-                keyword_hits.extend(fuzzy_match_multi_field(broader_items, word))
-
-            seen = set()
-            deduped = []
-            for i in keyword_hits:
-                k = i.get("key")
-                if k and k not in seen:
-                    seen.add(k)
-                    deduped.append(i)
-
-            if deduped:
-                return jsonify([
-                    {
-                        "title": i["data"].get("title", "Untitled"),
-                        "key": i.get("key"),
-                        "type": i["data"].get("itemType"),
-                        "creators": [c.get("lastName", "") for c in i["data"].get("creators", [])],
-                        "abstract": i["data"].get("abstractNote", "")
-                    }
-                    for i in deduped
+                    for i in ranked
                 ])
 
             return jsonify({
                 "error": f"No items found for query '{q}'",
-                "suggestions": suggest_alternatives(broader_items, q)
+                "suggestions": suggest_alternatives(mirror, q)
             }), 404
 
         return jsonify({"error": "No items found"}), 404
 
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return error_response(e)
 
 
 
@@ -489,271 +427,198 @@ def summarize_collection():
     if not collection_name:
         return jsonify({"error": "Missing collection name"}), 400
 
-    try:
-        user_id = get_user_id(api_key)
-        headers = get_headers(api_key)
-        app.logger.debug(f"[summarize_collection] User ID: {user_id}")
-        app.logger.debug(f"[summarize_collection] Collection requested: '{collection_name}'")
-
-        # Step 1: Get all matching collection references with library metadata
-        collection_refs = get_collection_keys_by_name(api_key, user_id, collection_name, headers)
-        app.logger.debug(f"[summarize_collection] Matched collections: {collection_refs}")
-        if not collection_refs:
-            return jsonify({"error": f"No matching collection found for '{collection_name}'"}), 404
-
-        # Step 2: Load nested collections once
-        nested_map = get_all_nested_keys(api_key, user_id, headers)
-
-        # Step 3: Group collections by (library_type, library_id)
-        from collections import defaultdict
-        grouped_keys = defaultdict(set)
-        for ref in collection_refs:
-            key = ref["key"]
-            lib_type = ref["library_type"]
-            lib_id = ref["library_id"]
-            grouped_keys[(lib_type, lib_id)].add(str(key))
-            grouped_keys[(lib_type, lib_id)].update(map(str, nested_map.get(key, [])))
-
-        pdf_summaries = []
-        fallback_titles = []
-
-        # Step 4: Loop through each library
-        for (lib_type, lib_id), keys in grouped_keys.items():
-            lib_path = f"{lib_type}s/{lib_id}"
-            try:
-                item_res = requests.get(
-                    f"{ZOTERO_BASE_URL}/{lib_path}/items",
-                    headers=headers,
-                    params={
-                        "format": "json",
-                        "collection": ",".join(keys),
-                        "limit": 200
-                    }
-                )
-                app.logger.debug(f"[summarize_collection] Request URL: {item_res.url}")
-                app.logger.debug(f"[summarize_collection] Status Code: {item_res.status_code}")
-                items = item_res.json()
-            except Exception as e:
-                app.logger.error(f"[summarize_collection] Error fetching items: {e}")
-                return jsonify({"error": "Failed to fetch items from Zotero"}), 500
-
-
-
-
-
-            for item in items:
-                app.logger.debug(f"[summarize_collection] Processing item: {item.get('data', {}).get('title', 'Untitled')}")
-                data = item.get("data", {})
-                key = item.get("key")
-                title = data.get("title", "Untitled")
-                item_type = data.get("itemType")
-                creators = [c.get("lastName", "") for c in data.get("creators", [])]
-
-                if item_type != "attachment":
-                    fallback_titles.append(title)
-
-                    # Check for child PDFs
-                    try:
-                        child_res = requests.get(
-                            f"{ZOTERO_BASE_URL}/{lib_path}/items/{key}/children",
-                            headers=headers,
-                            timeout=10
-                        )
-                        child_res.raise_for_status()
-                        children = child_res.json()
-                    except Exception as e:
-                        app.logger.error(f"[summarize_collection] Error fetching children for item {key}: {e}")
-                        continue
-
-    
-                    for child in children:
-                        cdata = child.get("data", {})
-                        if cdata.get("itemType") == "attachment" and cdata.get("contentType") == "application/pdf":
-                            try:
-                                text = extract_pdf_text(api_key, user_id, child["key"], headers, lib_type, lib_id)
-                            except Exception as e:
-                                app.logger.error(f"[summarize_collection] PDF extract failed for child {child['key']}: {e}")
-                                text = None
-                            if text:
-                                pdf_summaries.append({
-                                    "title": title,
-                                    "creators": creators,
-                                    "text": text
-                                })
-                elif data.get("contentType") == "application/pdf":
-                    try:
-                        text = extract_pdf_text(api_key, user_id, key, headers, lib_type, lib_id)
-                    except Exception as e:
-                        app.logger.error(f"[summarize_collection] PDF extract failed for item {key}: {e}")
-                        text = None
-                    if text:
-                        pdf_summaries.append({
-                            "title": title,
-                            "creators": creators,
-                            "text": text
-                        })
-                else:
-                    fallback_titles.append(title)
-
-        if not pdf_summaries:
-            return jsonify({
-                "note": "No readable PDFs found. Showing fallback titles only.",
-                "titles": fallback_titles
-            })
-
-        themes = extract_themes([s["text"] for s in pdf_summaries])
-        divergence = detect_divergence([s["text"] for s in pdf_summaries])
-
-        return jsonify({
-            "collection": collection_name,
-            "pdfs_read": len(pdf_summaries),
-            "themes": themes,
-            "divergent": divergence,
-            "docs": [{"title": s["title"], "creators": s["creators"]} for s in pdf_summaries]
-        })
+    events = summarize_collection_events(api_key, collection_name)
+    if request.args.get("stream") == "1":
+        return Response(stream_with_context(ndjson_lines(events)), mimetype="application/x-ndjson")
 
+    try:
+        for event in events:
+            if event["type"] == "error":
+                return jsonify({"error": event["error"]}), event["status"]
+            if event["type"] == "summary":
+                return jsonify({k: v for k, v in event.items() if k != "type"})
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return error_response(e)
 
 
-
-
-
-
-
-
-
-def get_all_nested_keys(api_key, user_id, headers):
+def ndjson_lines(events):
     """
-    Return a mapping of collection keys to their nested subcollection keys,
-    across both personal and group libraries.
-    """
-    all_collections = []
-
-    # Fetch personal collections
-    personal = requests.get(
-        f"{ZOTERO_BASE_URL}/users/{user_id}/collections", headers=headers
-    ).json()
-    for col in personal:
-        col["library_type"] = "user"
-        col["library_id"] = user_id
-    all_collections.extend(personal)
-
-    # Fetch group collections
-    groups = requests.get(
-        f"{ZOTERO_BASE_URL}/users/{user_id}/groups", headers=headers
-    ).json()
-
-    for group in groups:
-        gid = group.get("id")
-        try:
-            group_colls = requests.get(
-                f"{ZOTERO_BASE_URL}/groups/{gid}/collections", headers=headers
-            ).json()
-            for col in group_colls:
-                col["library_type"] = "group"
-                col["library_id"] = gid
-            all_collections.extend(group_colls)
-        except Exception:
-            continue
-
-    # Build parent-child map
-    parent_map = {}
-    for c in all_collections:
-        parent = c["data"].get("parentCollection")
-        if parent:
-            parent_map.setdefault(parent, []).append(c["data"]["key"])
-
-    # Recursive gatherer
-    def gather(k):
-        out = set()
-        children = parent_map.get(k, [])
-        out.update(children)
-        for c in children:
-            out.update(gather(c))
-        return out
-
-    nested = {}
-    for c in all_collections:
-        k = c["data"]["key"]
-        nested[k] = gather(k)
-
-    return nested
-
-
-
-
-
-
-
-
-def extract_pdf_text(api_key, user_id, item_key, headers, lib_type="user", lib_id=None):
-    """
-    Download and extract text from a Zotero PDF attachment.
-    Supports both user and group libraries. Uses fitz for PDF parsing.
+    Serialize events as NDJSON, ending with an error record if one fails.
     """
     try:
-        if lib_type == "user":
-            lib_id = user_id
-        lib_path = f"{lib_type}s/{lib_id}"
-
-        file_url = f"{ZOTERO_BASE_URL}/{lib_path}/items/{item_key}/file"
-        res = requests.get(file_url, headers=headers, stream=True)
-
-        if res.status_code != 200:
-            app.logger.warning(f"[extract_pdf_text] File not found or inaccessible: {file_url}")
-            return None
-
-        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as tmp:
-            for chunk in res.iter_content(chunk_size=8192):
-                if chunk:
-                    tmp.write(chunk)
-            tmp_path = tmp.name
-
-        doc = fitz.open(tmp_path)
-        text = "\n".join([p.get_text() for p in doc])
-        doc.close()
-        os.remove(tmp_path)
-        gc.collect()
-
-        return text.strip() if text.strip() else None
-
+        for event in events:
+            yield json.dumps(event) + "\n"
     except Exception as e:
-        app.logger.error(f"[extract_pdf_text ERROR] {e}")
-        return None
-
-
-
-
-
-
-
-
+        app.logger.error(f"[ndjson_lines] Stream failed: {e}")
+        error = {"type": "error", "error": str(e), "status": 500}
+        if isinstance(e, ZoteroRateLimited):
+            error.update(status=503, retry_after=math.ceil(e.retry_after))
+        yield json.dumps(error) + "\n"
 
 
-def extract_themes(texts):
-    keywords = ["equity", "lab", "sensemaking", "argument", "TA", "instruction", "framework"]
-    found = set()
-    for t in texts:
-        for k in keywords:
-            if k in t.lower():
-                found.add(k)
-    return list(found)
-
+def summarize_collection_events(api_key, collection_name):
+    """
+    Summarize a collection step by step, yielding one event dict at a time:
+    "collections" (the matched collections), then a "document" for each PDF
+    as it is read, then the "summary" with the collection's themes and
+    divergence. Yields a single "error" event if nothing matches.
+    """
+    user_id = get_user_id(api_key)
+    headers = get_headers(api_key)
+    app.logger.debug(f"[summarize_collection] User ID: {user_id}")
+    app.logger.debug(f"[summarize_collection] Collection requested: '{collection_name}'")
+
+    # Step 1: Get all matching collection references with library metadata
+    collection_refs = get_collection_keys_by_name(api_key, user_id, collection_name, headers)
+    app.logger.debug(f"[summarize_collection] Matched collections: {collection_refs}")
+    if not collection_refs:
+        yield {
+            "type": "error", "error": f"No matching collection found for '{collection_name}'", "status": 404
+        }
+        return
+    yield {
+        "type": "collections",
+        "collections": [
+            {k: ref.get(k) for k in ("key", "path", "library_type", "library_id")} for ref in collection_refs
+        ]
+    }
+
+    # Step 2: Group collections by (library_type, library_id).
+    # collection_refs already include every nested subcollection.
+    from collections import defaultdict
+    grouped_keys = defaultdict(set)
+    for ref in collection_refs:
+        grouped_keys[(ref["library_type"], ref["library_id"])].add(str(ref["key"]))
 
-def detect_divergence(texts):
-    # Dummy check: find outliers by word count
-    if len(texts) < 2:
-        return []
-    lengths = [len(t.split()) for t in texts]
-    avg = sum(lengths) / len(lengths)
-    outliers = []
-    for i, l in enumerate(lengths):
-        if abs(l - avg) > 0.5 * avg:
-            outliers.append(f"Doc {i+1} is unusually {'long' if l > avg else 'short'}")
-    return outliers
+    pdf_jobs = []
+    fallback_titles = []
 
+    # Step 3: Loop through each library
+    for (lib_type, lib_id), keys in grouped_keys.items():
+        lib_path = f"{lib_type}s/{lib_id}"
+        # Read the items and their attachments from the library mirror;
+        # only the list of attachments with server-side full text still
+        # comes from Zotero
+        notes = notes_access(api_key, lib_path)
+        mirror = synced_mirror(lib_path, headers, notes=notes)
+        items = mirror.items(collection_keys=keys, exclude_types=None if notes else ("note",))
+        attachments = mirror.children([item.get("key") for item in items], item_type="attachment")
+        try:
+            fulltext_versions = get_fulltext_versions(lib_path, headers)
+        except Exception as e:
+            app.logger.warning(f"[summarize_collection] No full-text listing for {lib_path}: {e}")
+            fulltext_versions = None
+        app.logger.debug(f"[summarize_collection] Fetched {len(items)} items, {len(attachments)} attachments from {lib_path}")
+
+        def has_fulltext(attachment_key):
+            return None if fulltext_versions is None else attachment_key in fulltext_versions
+
+        child_pdfs = defaultdict(list)
+        for att in attachments:
+            adata = att.get("data", {})
+            if adata.get("parentItem") and adata.get("contentType") == "application/pdf":
+                child_pdfs[adata["parentItem"]].append(att)
+        item_keys = {item.get("key") for item in items}
+
+        for item in items:
+            app.logger.debug(f"[summarize_collection] Processing item: {item.get('data', {}).get('title', 'Untitled')}")
+            data = item.get("data", {})
+            key = item.get("key")
+            title = data.get("title", "Untitled")
+            item_type = data.get("itemType")
+            creators = [c.get("lastName", "") for c in data.get("creators", [])]
+
+            if item_type != "attachment":
+                fallback_titles.append(title)
+
+                for child in child_pdfs.get(key, []):
+                    pdf_jobs.append({
+                        "key": child["key"],
+                        "item_key": key,
+                        "lib_path": lib_path,
+                        "fingerprint": attachment_fingerprint(child.get("data", {})),
+                        "fulltext": has_fulltext(child["key"]),
+                        "title": title,
+                        "creators": creators
+                    })
+            elif data.get("parentItem") in item_keys:
+                continue  # read above through its parent item
+            elif data.get("contentType") == "application/pdf":
+                pdf_jobs.append({
+                    "key": key,
+                    "item_key": key,
+                    "lib_path": lib_path,
+                    "fingerprint": attachment_fingerprint(data),
+                    "fulltext": has_fulltext(key),
+                    "title": title,
+                    "creators": creators
+                })
+            else:
+                fallback_titles.append(title)
+
+    # Step 4: Download and parse all PDFs through the pipelined extractor,
+    # reporting each document as soon as it finishes, whatever its position.
+    # Each text is folded into the theme model's term counts and the
+    # library's search index as soon as it arrives, then released, so only
+    # the documents in flight are ever held in memory.
+    position = {id(job): i for i, job in enumerate(pdf_jobs)}
+    pdf_summaries = []
+    model = ThemeModel()
+    for n, (job, text) in enumerate(extract_pdf_texts(pdf_jobs, headers, ordered=False), 1):
+        if text:
+            get_library_index(job["lib_path"]).add(job["key"], text, job["item_key"], job["title"])
+            model.add_document(text)
+            pdf_summaries.append({
+                "title": job["title"], "creators": job["creators"], "position": position[id(job)]
+            })
+        yield {
+            "type": "document",
+            "done": n,
+            "total": len(pdf_jobs),
+            "item_key": job["item_key"],
+            "title": job["title"],
+            "creators": job["creators"],
+            "readable": bool(text),
+            "chars": len(text or "")
+        }
+        del text
 
+    if not pdf_summaries:
+        yield {
+            "type": "summary",
+            "note": "No readable PDFs found. Showing fallback titles only.",
+            "titles": fallback_titles
+        }
+        return
+
+    themes = model.themes()
+    divergence = [
+        {
+            "title": pdf_summaries[d["doc"]]["title"],
+            "distance": d["distance"],
+            "z_score": d["z_score"],
+            "nearest": [
+                {"title": pdf_summaries[n["doc"]]["title"], "similarity": n["similarity"]}
+                for n in d["nearest"]
+            ]
+        }
+        for d in model.divergence()
+    ]
+
+    yield {
+        "type": "summary",
+        "collection": collection_name,
+        "pdfs_read": len(pdf_summaries),
+        "themes": themes["collection"],
+        "divergent": divergence,
+        # Documents in collection order, however their reads finished
+        "docs": [
+            {"title": s["title"], "creators": s["creators"], "themes": doc_themes}
+            for s, doc_themes in sorted(
+                zip(pdf_summaries, themes["documents"]), key=lambda pair: pair[0]["position"]
+            )
+        ]
+    }
 
 
 
@@ -776,42 +641,28 @@ def get_notes():
     try:
         user_id = get_user_id(api_key)
         headers = get_headers(api_key)
+        # The mirror may have been synced by a key with more access than this one
+        if not notes_access(api_key, f"users/{user_id}"):
+            return jsonify({"error": "This API key does not have access to notes"}), 403
 
         # Step 1: Resolve itemKey using query if not provided
         if not item_key and query:
-            search_params = {
-                "format": "json",
-                "q": query,
-                "qmode": "titleCreatorYear",
-                "limit": 50
-            }
-
             # Apply collection filter
+            collection_keys = None
             if collection_name:
                 if collection_name.startswith("collectionkey:"):
-                    search_params["collection"] = collection_name.split(":", 1)[-1].strip()
+                    collection_keys = [collection_name.split(":", 1)[-1].strip()]
                 else:
                     collection_refs = get_collection_keys_by_name(api_key, user_id, collection_name, headers)
-                    collection_keys = [ref["key"] for ref in collection_refs]
-                    if collection_keys:
-                        search_params["collection"] = ",".join(collection_keys)
+                    collection_keys = [ref["key"] for ref in collection_refs] or None
 
-            # Initial search
-            search_res = requests.get(
-                f"{ZOTERO_BASE_URL}/users/{user_id}/items",
-                headers=headers,
-                params=search_params
-            )
-            items = search_res.json()
+            # Initial search, against the local mirror of the personal library
+            mirror = synced_mirror(f"users/{user_id}", headers, notes=True)
+            items = mirror.search(query, collection_keys, limit=50)
 
             # Fallback broader search if nothing found
             if not items and query:
-                fallback_res = requests.get(
-                    f"{ZOTERO_BASE_URL}/users/{user_id}/items",
-                    headers=headers,
-                    params={"format": "json", "q": query, "limit": 100}
-                )
-                items = fallback_res.json()
+                items = mirror.search(query, limit=100)
 
             # Try multi-field fuzzy match
             fuzzy_matches = fuzzy_match_multi_field(items, collection_name or query)
@@ -832,12 +683,7 @@ def get_notes():
             return jsonify({"error": "Missing itemKey or failed to resolve query"}), 404
 
         # Step 2: Retrieve notes (children) for the itemKey
-        notes_res = requests.get(
-            f"{ZOTERO_BASE_URL}/users/{user_id}/items/{item_key}/children",
-            headers=headers,
-            params={"itemType": "note"}
-        )
-        notes = notes_res.json()
+        notes = synced_mirror(f"users/{user_id}", headers, notes=True).children([item_key], item_type="note")
 
         if not notes:
             return jsonify({"message": "No notes found for this item."}), 204
@@ -845,7 +691,7 @@ def get_notes():
         return jsonify(notes)
 
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return error_response(e)
 
 
 
@@ -862,10 +708,23 @@ def read_pdf():
     item_key = request.args.get("itemKey")
     title = request.args.get("title", "").strip()
     collection_name = request.args.get("collection", "").strip().lower()
+    pages = request.args.get("pages", "").strip()
+    cursor = request.args.get("cursor", "").strip()
 
     if not api_key:
         return jsonify({"error": "Missing api_key"}), 400
 
+    # Optional page selection ("1-3,7") and continuation cursor ("page:offset")
+    try:
+        page_ranges = parse_page_ranges(pages) if pages else None
+        if cursor:
+            cursor_page, _, cursor_offset = cursor.partition(":")
+            cursor = (int(cursor_page), int(cursor_offset or 0))
+        else:
+            cursor = (1, 0)
+    except ValueError as e:
+        return jsonify({"error": f"Invalid pages or cursor: {e}"}), 400
+
     try:
         headers = get_headers(api_key)
         user_id = get_user_id(api_key)
@@ -875,8 +734,7 @@ def read_pdf():
             search_params = {
                 "format": "json",
                 "q": title,
-                "qmode": "title",
-                "limit": 5
+                "qmode": "title"
             }
 
             # Resolve collection key(s)
@@ -889,21 +747,21 @@ def read_pdf():
                     if collection_keys:
                         search_params["collection"] = ",".join(collection_keys)
 
-            item_res = requests.get(
-                f"{ZOTERO_BASE_URL}/users/{user_id}/items",
+            items = zotero_get_all(
+                f"/users/{user_id}/items",
                 headers=headers,
-                params=search_params
+                params=search_params,
+                max_results=5
             )
-            items = item_res.json()
 
             if not items:
                 # Try broader match
-                fallback_res = requests.get(
-                    f"{ZOTERO_BASE_URL}/users/{user_id}/items",
+                items = zotero_get_all(
+                    f"/users/{user_id}/items",
                     headers=headers,
-                    params={"format": "json", "q": title, "limit": 25}
+                    params={"format": "json", "q": title},
+                    max_results=25
                 )
-                items = fallback_res.json()
                 items = fuzzy_match_multi_field(items, title)
 
             if items:
@@ -921,8 +779,8 @@ def read_pdf():
             return jsonify({"error": "Missing itemKey"}), 400
 
         # Step 2: Get metadata and determine library scope
-        item_res = requests.get(
-            f"{ZOTERO_BASE_URL}/users/{user_id}/items/{item_key}",
+        item_res = zotero_get(
+            f"/users/{user_id}/items/{item_key}",
             headers=headers
         )
 
@@ -934,14 +792,14 @@ def read_pdf():
         library = item_data["library"]
         library_type = library["type"]
         library_id = library["id"]
+        attachment = item_data["data"]
 
         # Step 3: If not an attachment, search children for PDF
         if item_type != "attachment":
-            children_res = requests.get(
-                f"{ZOTERO_BASE_URL}/{library_type}s/{library_id}/items/{item_key}/children",
+            children = zotero_get_all(
+                f"/{library_type}s/{library_id}/items/{item_key}/children",
                 headers=headers
             )
-            children = children_res.json()
             pdfs = [
                 c for c in children
                 if c["data"].get("itemType") == "attachment" and
@@ -950,34 +808,155 @@ def read_pdf():
             if not pdfs:
                 return jsonify({"error": "No PDF attachment found for this item"}), 404
             item_key = pdfs[0]["key"]
+            attachment = pdfs[0]["data"]
 
-        # Step 4: Download and extract PDF
-        file_res = requests.get(
-            f"{ZOTERO_BASE_URL}/{library_type}s/{library_id}/items/{item_key}/file",
-            headers=headers,
-            stream=True
-        )
-        if file_res.status_code != 200:
-            return jsonify({"error": "Could not download PDF file"}), file_res.status_code
-
-        with open("temp.pdf", "wb") as f:
-            for chunk in file_res.iter_content(chunk_size=8192):
-                f.write(chunk)
-
-        doc = fitz.open("temp.pdf")
-        text = "\n".join([page.get_text() for page in doc])
-        doc.close()
-
-        if not text.strip():
+        # Step 4: Read pages until the character budget is used (from the text
+        # cache when possible), stopping before parsing the rest of the PDF
+        try:
+            result = read_pdf_pages(
+                f"{library_type}s/{library_id}", item_key, headers, attachment_fingerprint(attachment),
+                page_ranges=page_ranges, cursor=cursor, max_chars=READ_PDF_MAX_CHARS
+            )
+        except PdfTooLarge as e:
+            return jsonify({"error": str(e)}), 413
+        except TimeoutError as e:
+            return jsonify({"error": f"PDF parsing timed out: {e}"}), 504
+        except ParseError as e:
+            return jsonify({"error": f"Could not parse PDF: {e}"}), 422
+        if result is None:
+            return jsonify({"error": "Could not download PDF file"}), 404
+
+        if not result["text"].strip() and not result["next_cursor"]:
             return jsonify({"error": "PDF extracted but contains no readable text."}), 204
 
+        # A whole document read in one go goes into the search index too
+        if not page_ranges and cursor == (1, 0) and not result["next_cursor"]:
+            if result["source"] == "zotero_fulltext":
+                full_text = result["text"]
+            else:
+                full_text = text_cache.get(item_key, attachment_fingerprint(attachment))
+            if full_text:
+                get_library_index(f"{library_type}s/{library_id}").add(
+                    item_key, full_text, item_data["key"], item_data["data"].get("title")
+                )
+
+        next_cursor = result["next_cursor"]
         return jsonify({
             "title": title or item_key,
-            "text": text[:15000]  # Trimmed for safety
+            "text": result["text"],
+            "page_count": result["page_count"],
+            "pages": result["pages"],
+            "next_cursor": f"{next_cursor[0]}:{next_cursor[1]}" if next_cursor else None,
+            "source": result["source"]
         })
 
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return error_response(e)
+
+
+
+
+
+
+@app.route("/search_fulltext", methods=["GET"])
+def search_fulltext():
+    """
+    BM25 search over the text of every PDF this service has already read
+    (via /summarize_collection or /read_pdf) in the user's libraries.
+    Answered from the local index, without calling Zotero once the user's
+    libraries are cached.
+    """
+    api_key = request.args.get("api_key")
+    query = request.args.get("q", "").strip()
+    if not api_key:
+        return jsonify({"error": "Missing api_key"}), 400
+    if not query:
+        return jsonify({"error": "Missing query"}), 400
+    try:
+        limit = min(max(int(request.args.get("limit", 10)), 1), SEARCH_MAX_RESULTS)
+    except ValueError:
+        return jsonify({"error": "Invalid limit"}), 400
+
+    try:
+        headers = get_headers(api_key)
+        user_id = get_user_id(api_key)
+        lib_paths = [f"users/{user_id}"] + [
+            f"groups/{group.get('id')}" for group in get_user_groups(api_key, user_id, headers)
+        ]
+
+        hits = []
+        indexed = 0
+        for lib_path in lib_paths:
+            index = get_library_index(lib_path)
+            indexed += len(index)
+            for score, attachment_key, meta, snippets in index.search(query, limit):
+                hits.append({
+                    "key": meta["item_key"],
+                    "attachment_key": attachment_key,
+                    "title": meta["title"],
+                    "library": lib_path,
+                    "score": round(score, 4),
+                    "snippets": [
+                        {"term": term, "page": page, "offset": offset, "cursor": f"{page}:{offset}"}
+                        for term, page, offset in snippets
+                    ]
+                })
+        hits.sort(key=lambda h: h["score"], reverse=True)
+
+        response = {"query": query, "indexed_documents": indexed, "results": hits[:limit]}
+        if not indexed:
+            response["note"] = "No PDFs indexed yet. Read some with /summarize_collection or /read_pdf first."
+        return jsonify(response)
+
+    except Exception as e:
+        return error_response(e)
+
+
+
+
+
+
+def summarize_collection_job(api_key, collection):
+    """
+    Job body for /jobs/summarize_collection; runs outside any request.
+    """
+    with app.app_context():
+        yield from summarize_collection_events(api_key, collection)
+
+
+@app.route("/jobs/summarize_collection", methods=["POST"])
+def create_summarize_job():
+    body = request.get_json(silent=True) or {}
+    api_key = request.args.get("api_key") or body.get("api_key")
+    collection_name = (request.args.get("collection") or body.get("collection") or "").strip().lower()
+
+    if not api_key:
+        return jsonify({"error": "Missing Zotero API key"}), 400
+    if not collection_name:
+        return jsonify({"error": "Missing collection name"}), 400
+
+    try:
+        job_id, created = submit_job(
+            "summarize_collection", api_key, {"collection": collection_name}, summarize_collection_job
+        )
+        return jsonify({"job_id": job_id, "created": created}), 202, {"Location": f"/jobs/{job_id}"}
+    except Exception as e:
+        return error_response(e)
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job_status(job_id):
+    api_key = request.args.get("api_key")
+    if not api_key:
+        return jsonify({"error": "Missing Zotero API key"}), 400
+
+    try:
+        job = get_job(job_id, api_key)
+        if job is None:
+            return jsonify({"error": f"No job {job_id}"}), 404
+        return jsonify(job)
+    except Exception as e:
+        return error_response(e)
 
 
 
@@ -995,8 +974,11 @@ def extract_themes_endpoint():
     if not texts or not isinstance(texts, list):
         return jsonify({"error": "Provide a list of 'texts'"}), 400
 
-    themes = extract_themes(texts)
-    divergence = detect_divergence(texts)
+    model = ThemeModel()
+    for text in texts:
+        model.add_document(text)
+    themes = model.themes()
+    divergence = model.divergence()
 
     return jsonify({
         "themes": themes,
@@ -0,0 +1,378 @@
+"""
+Shared upstream client for the Zotero Web API.
+
+All calls to api.zotero.org run as coroutines on one asyncio event loop per
+worker process, owned by a background thread and served by a single pooled
+httpx.AsyncClient. Route handlers stay synchronous (gunicorn's gthread
+worker runs many of them per process) and hand their upstream work to that
+loop: a waiting handler only parks its own thread, while the loop multiplexes
+every in-flight Zotero request of the worker over at most
+ZOTERO_MAX_CONNECTIONS connections. Pagination and fan-out run on the loop
+too, with semaphores bounding how much one call may have in flight.
+
+Every request is paced by its API key's scheduler (see rate_limit.py) and
+retried on 429/5xx responses and transport errors. Identical GETs (same key,
+URL, params and headers) that are in flight at the same time are sent once
+and share the response; streamed downloads are not shared at this level.
+
+Synchronous code calls zotero_get / zotero_iter / zotero_get_all / run;
+coroutines can use zotero_aget / zotero_aiter / zotero_aget_all directly.
+"""
+import asyncio
+import contextvars
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+
+from key_cache import hash_api_key, key_cache
+from rate_limit import (
+    MAX_RETRIES, QUEUE_TIMEOUT, RETRY_MAX_DELAY, RETRY_STATUSES, ZoteroRateLimited,
+    get_scheduler, parse_delay, retry_delay, upstream_priority
+)
+from single_flight import AsyncSingleFlight
+from worker_local import ProcessLocal
+
+
+ZOTERO_BASE_URL = "https://api.zotero.org"
+
+# Upstream connections the worker may open at once, and how many idle ones to keep.
+MAX_CONNECTIONS = int(os.environ.get("ZOTERO_MAX_CONNECTIONS", "200"))
+MAX_KEEPALIVE = int(os.environ.get("ZOTERO_POOL_MAXSIZE", "32"))
+
+# Default connect and read timeouts in seconds for every upstream call.
+CONNECT_TIMEOUT = float(os.environ.get("ZOTERO_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.environ.get("ZOTERO_READ_TIMEOUT", "30"))
+DEFAULT_TIMEOUT = httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT)
+
+# Zotero returns at most 100 results per page of a list endpoint.
+PAGE_SIZE = 100
+# Pages of a single listing in flight at once after the first one.
+PAGE_CONCURRENCY = int(os.environ.get("ZOTERO_PAGE_CONCURRENCY", "8"))
+
+# Threads shared by all fan_out calls (for blocking callables) in a worker,
+# and how many items a single fan_out call may run at once.
+FANOUT_WORKERS = int(os.environ.get("ZOTERO_FANOUT_WORKERS", "16"))
+FANOUT_CONCURRENCY = int(os.environ.get("ZOTERO_FANOUT_CONCURRENCY", "8"))
+
+
+
+# Helper to build auth headers
+def get_headers(api_key):
+    return {"Zotero-API-Key": api_key}
+
+
+def _build_client():
+    return httpx.AsyncClient(
+        headers={"Zotero-API-Version": "3"},
+        limits=httpx.Limits(max_connections=MAX_CONNECTIONS, max_keepalive_connections=MAX_KEEPALIVE),
+        timeout=DEFAULT_TIMEOUT,
+    )
+
+
+class _Engine:
+    """
+    An event loop running in a daemon thread, plus the client that lives on it
+    and the requests in flight on it.
+    """
+    def __init__(self):
+        self.flights = AsyncSingleFlight()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="zotero-upstream", daemon=True)
+        self.thread.start()
+        self.client = self.run(self._start())
+
+    async def _start(self):
+        return _build_client()
+
+    def run(self, coro, timeout=None):
+        """
+        Run a coroutine on the loop from any other thread and return its result.
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+
+_engines = ProcessLocal(_Engine)
+
+
+def get_engine():
+    """
+    Return this worker process's upstream engine, starting it on first use.
+    Gunicorn forks workers, so an engine inherited from another pid (whose
+    loop thread did not survive the fork) is replaced.
+    """
+    return _engines.get()
+
+
+def run(coro, timeout=None):
+    """
+    Run an upstream coroutine to completion from synchronous code.
+    """
+    return get_engine().run(coro, timeout)
+
+
+def _url(path):
+    return path if path.startswith("http") else f"{ZOTERO_BASE_URL}{path}"
+
+
+def _timeout(timeout):
+    return DEFAULT_TIMEOUT if timeout is None else httpx.Timeout(timeout, connect=CONNECT_TIMEOUT)
+
+
+def _check_forbidden(res, headers):
+    # A 403 means the key was revoked or lost access; drop what we cached for it
+    if res.status_code == 403 and headers and headers.get("Zotero-API-Key"):
+        key_cache.invalidate(headers["Zotero-API-Key"])
+
+
+async def _scheduled(send, headers, timeout=None):
+    """
+    Run send() (an idempotent GET) under the API key's scheduler at the
+    current request's priority. Honours Backoff and Retry-After, and retries
+    429/5xx responses and transport errors with jittered exponential backoff.
+    Raises ZoteroRateLimited if the key is still throttled after the retries,
+    when Zotero asks for a longer pause than we are willing to wait, or when
+    the key's queue does not admit the call within the timeout.
+    """
+    scheduler = get_scheduler(headers)
+    priority = upstream_priority.get()
+    queue_timeout = QUEUE_TIMEOUT if timeout is None else min(timeout, QUEUE_TIMEOUT)
+    retry_after = None
+    for attempt in range(MAX_RETRIES + 1):
+        await scheduler.acquire(priority, queue_timeout)
+        try:
+            res = await send()
+        except httpx.TransportError:
+            if attempt == MAX_RETRIES:
+                raise
+            await asyncio.sleep(retry_delay(attempt))
+            continue
+
+        backoff = parse_delay(res.headers.get("Backoff"))
+        if backoff:
+            scheduler.pause(backoff)
+        if res.status_code not in RETRY_STATUSES:
+            _check_forbidden(res, headers)
+            return res
+
+        retry_after = parse_delay(res.headers.get("Retry-After"))
+        if retry_after:
+            scheduler.pause(retry_after)
+        if attempt == MAX_RETRIES or (retry_after or 0) > RETRY_MAX_DELAY:
+            break
+        await res.aclose()
+        await asyncio.sleep(retry_delay(attempt))
+
+    if res.status_code == 429:
+        await res.aclose()
+        raise ZoteroRateLimited(retry_after or scheduler.remaining_pause() or RETRY_MAX_DELAY)
+    return res
+
+
+def request_key(path, headers=None, params=None):
+    """
+    Identity of a GET for coalescing: the API key (hashed), URL, params and
+    any other request headers.
+    """
+    return (
+        _url(path),
+        tuple(sorted((k, str(v)) for k, v in (params or {}).items())),
+        tuple(sorted(
+            (k, hash_api_key(v) if k == "Zotero-API-Key" else str(v)) for k, v in (headers or {}).items()
+        ))
+    )
+
+
+async def zotero_aget(path, headers=None, params=None, timeout=None):
+    """
+    GET a Zotero API path (e.g. "/users/123/items") or absolute URL and
+    return the httpx.Response with its body read. Concurrent identical
+    calls share one upstream request and its response.
+    """
+    engine = get_engine()
+
+    async def send():
+        return await _scheduled(
+            lambda: engine.client.get(_url(path), headers=headers, params=params, timeout=_timeout(timeout)),
+            headers, timeout
+        )
+
+    return await engine.flights.do(request_key(path, headers, params), send)
+
+
+class StreamingResponse:
+    """
+    Blocking view of a streamed upstream response whose body is read chunk by
+    chunk on the engine's loop.
+    """
+    def __init__(self, engine, response):
+        self._engine = engine
+        self._response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+
+    def iter_content(self, chunk_size=64 * 1024, deadline=None):
+        """
+        Yield the body in chunks. With a deadline (a time.monotonic() value),
+        raise TimeoutError once it passes, even while waiting for a chunk.
+        """
+        chunks = self._response.aiter_bytes(chunk_size)
+
+        async def next_chunk():
+            try:
+                if deadline is None:
+                    return await chunks.__anext__()
+                return await asyncio.wait_for(chunks.__anext__(), deadline - time.monotonic())
+            except StopAsyncIteration:
+                return None
+            except asyncio.TimeoutError:
+                raise TimeoutError("Timed out reading the response body") from None
+
+        while True:
+            chunk = self._engine.run(next_chunk())
+            if chunk is None:
+                return
+            yield chunk
+
+    def close(self):
+        self._engine.run(self._response.aclose())
+
+
+async def _open_stream(path, headers, params, timeout):
+    client = get_engine().client
+    request = client.build_request("GET", _url(path), headers=headers, params=params, timeout=_timeout(timeout))
+    return await _scheduled(lambda: client.send(request, stream=True), headers, timeout)
+
+
+def zotero_get(path, headers=None, params=None, stream=False, timeout=None):
+    """
+    Blocking GET through the upstream engine. With stream=True the body is
+    not read up front; iterate it with iter_content() and close() it.
+    """
+    engine = get_engine()
+    if stream:
+        return StreamingResponse(engine, engine.run(_open_stream(path, headers, params, timeout)))
+    return engine.run(zotero_aget(path, headers, params, timeout))
+
+
+async def _aget_page(path, headers, params, start, limit):
+    res = await zotero_aget(path, headers=headers, params={**params, "start": start, "limit": limit})
+    if res.status_code != 200:
+        raise Exception(f"Zotero request failed ({res.status_code}) for {path}")
+    return res.json(), int(res.headers.get("Total-Results", 0))
+
+
+async def _aiter_pages(path, headers, params, max_results, max_concurrency):
+    """
+    Yield the result pages of a Zotero list endpoint, in order.
+
+    The first page tells us Total-Results; the remaining start= pages are
+    then requested concurrently, at most max_concurrency at a time, and each
+    is yielded as soon as it (and every page before it) has arrived.
+    """
+    params = {k: v for k, v in (params or {}).items() if k not in ("start", "limit")}
+    page_size = PAGE_SIZE if max_results is None else min(PAGE_SIZE, max_results)
+
+    results, total = await _aget_page(path, headers, params, 0, page_size)
+    yield results
+    if len(results) < page_size:
+        return
+    if max_results is not None:
+        total = min(total, max_results)
+
+    pending = deque()
+    try:
+        for start in range(page_size, total, page_size):
+            if len(pending) >= max_concurrency:
+                yield (await pending.popleft())[0]
+            pending.append(asyncio.ensure_future(
+                _aget_page(path, headers, params, start, min(page_size, total - start))
+            ))
+        while pending:
+            yield (await pending.popleft())[0]
+    finally:
+        for task in pending:
+            task.cancel()
+
+
+async def zotero_aiter(path, headers=None, params=None, max_results=None, max_concurrency=PAGE_CONCURRENCY):
+    """
+    Yield every result of a Zotero list endpoint, in order, as its page
+    arrives. max_results caps the number of results for lookups that only
+    need the top matches.
+    """
+    async for page in _aiter_pages(path, headers, params, max_results, max_concurrency):
+        for result in page:
+            yield result
+
+
+def zotero_iter(path, headers=None, params=None, max_results=None, max_concurrency=PAGE_CONCURRENCY):
+    """
+    Blocking version of zotero_aiter: yields results while later pages are
+    still being fetched on the upstream loop.
+    """
+    engine = get_engine()
+    pages = _aiter_pages(path, headers, params, max_results, max_concurrency)
+
+    async def next_page():
+        try:
+            return await pages.__anext__()
+        except StopAsyncIteration:
+            return None
+
+    try:
+        while True:
+            page = engine.run(next_page())
+            if page is None:
+                return
+            yield from page
+    finally:
+        engine.run(pages.aclose())
+
+
+async def zotero_aget_all(path, headers=None, params=None, max_results=None, max_concurrency=PAGE_CONCURRENCY):
+    """
+    Return the complete result list of a Zotero list endpoint, in order.
+    """
+    return [r async for r in zotero_aiter(path, headers, params, max_results, max_concurrency)]
+
+
+def zotero_get_all(path, headers=None, params=None, max_results=None):
+    """
+    Blocking version of zotero_aget_all.
+    """
+    return list(zotero_iter(path, headers=headers, params=params, max_results=max_results))
+
+
+_fanout_executor = ProcessLocal(
+    lambda: ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="zotero-fanout")
+)
+
+
+def fan_out(fn, items, max_concurrency=FANOUT_CONCURRENCY):
+    """
+    Call the blocking function fn(item) for every item concurrently, at most
+    max_concurrency at a time, on a shared thread pool. Each call runs in a
+    copy of the caller's context, so it keeps the request's upstream priority.
+
+    Returns a list of (result, error) pairs in input order. An exception raised
+    for one item is captured as its error rather than failing the others.
+    """
+    slots = threading.BoundedSemaphore(max_concurrency)
+
+    def one(item):
+        try:
+            return fn(item), None
+        except Exception as e:
+            return None, e
+        finally:
+            slots.release()
+
+    futures = []
+    for item in items:
+        slots.acquire()
+        futures.append(_fanout_executor.get().submit(contextvars.copy_context().run, one, item))
+    return [f.result() for f in futures]